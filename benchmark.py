@@ -1,56 +1,197 @@
 # coding: utf-8
 
-import timeit
+''' Benchmark suite for mongodict
 
+Runs every combination of number of keys, value size, codec, index type and
+read/write mix against a MongoDB server and reports throughput and latency
+percentiles (p50, p95 and p99, in milliseconds) as JSON, so results of
+different releases can be compared. ``throughput`` is always computed from the
+wall time of the whole run (so reads and writes of a mixed run share it) and
+``busy_throughput`` from the time spent inside the operations. Example::
 
-test_code = '''
-import random
-import hashlib
-import redis
-from mongodict import MongoDict
-
-
-data = {}
-for counter in range(int(random.random() * 10000)):
-    my_hash = hashlib.sha512(str(counter)).hexdigest()
-    key = 'key-{}-{}'.format(str(counter), my_hash)
-    value = hashlib.sha512(key).hexdigest()
-    data[key] = value
-
-def test_redis():
-    redis_dict = redis.StrictRedis(host='localhost', port=6379, db=0)
-    for key in redis_dict.keys():
-        redis_dict.delete(key)
-    for key, value in data.iteritems():
-        redis_dict.set(key, value)
-        assert redis_dict.get(key) == value
-
-def test_mongodict(safe=True):
-    mongo_dict = MongoDict(safe=safe)
-    mongo_dict.clear()
-    for key, value in data.iteritems():
-        mongo_dict[key] = value
-        assert mongo_dict[key] == value
-
-def test_pythondict():
-    python_dict = {}
-    python_dict.clear()
-    for key, value in data.iteritems():
-        python_dict[key] = value
-        assert python_dict[key] == value
+    python benchmark.py --keys 1000 10000 --value-sizes 16 4096 \\
+                        --codecs pickle json --output results.json
+
+The benchmark database is dropped before each scenario and at the end.
 '''
 
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import math
+import platform
+import random
+import sys
+import timeit
+
+import pymongo
+
+from pymongo.errors import PyMongoError
+
+from mongodict import MongoDict, __version__, close_clients, get_client
+
+
+COLLECTION = 'benchmark'
+PERCENTILES = (50, 95, 99)
+timer = timeit.default_timer
+
+
+def percentile(sorted_values, percent):
+    ''' Return the nearest-rank ``percent`` percentile of ``sorted_values`` '''
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank - 1, 0)]
+
+def summarize(latencies, elapsed):
+    ''' Return throughput and latency percentiles (in milliseconds)
+
+    ``elapsed`` is the wall time of the run; ``busy_seconds`` is the time
+    spent inside these operations.
+    '''
+    latencies = sorted(latencies)
+    busy = sum(latencies)
+    summary = {'operations': len(latencies),
+               'seconds': elapsed,
+               'throughput': len(latencies) / elapsed if elapsed else None,
+               'busy_seconds': busy,
+               'busy_throughput': len(latencies) / busy if busy else None}
+    for percent in PERCENTILES:
+        value = percentile(latencies, percent)
+        summary['p{}'.format(percent)] = \
+                value * 1000 if value is not None else None
+    return summary
+
+def make_value(rng, size, codec):
+    ''' Return a random value with ``size`` bytes (before encoding)
+
+    The value is text (``unicode`` on Python 2) so ``bson`` stores it as a
+    native string instead of falling back to pickle; ``raw`` gets bytes.
+    '''
+    value = u'{:x}'.format(rng.getrandbits(size * 4)).zfill(size)[:size]
+    if codec == 'raw':
+        return value.encode('ascii')
+    return value
+
+def run_scenario(options, number_of_keys, value_size, codec, index_type,
+                 read_ratio):
+    ''' Load ``number_of_keys`` pairs and run a read/write mix over them '''
+    rng = random.Random(options.seed)
+    get_client(host=options.host, port=options.port)\
+            .drop_database(options.database)
+    close_clients() # so indexes are created again
+    my_dict = MongoDict(host=options.host, port=options.port,
+                        database=options.database, collection=COLLECTION,
+                        codec=codec, index_type=index_type)
+    keys = ['key-{:010d}'.format(number) for number in range(number_of_keys)]
+    values = [make_value(rng, value_size, codec)
+              for counter in range(min(number_of_keys, 100))]
+
+    start = timer()
+    my_dict.set_many((key, values[index % len(values)])
+                     for index, key in enumerate(keys))
+    load_time = timer() - start
+
+    operations = options.operations or number_of_keys
+    reads, writes = [], []
+    start = timer()
+    for counter in range(operations):
+        key = keys[rng.randrange(number_of_keys)]
+        if rng.random() < read_ratio:
+            operation_start = timer()
+            my_dict[key]
+            reads.append(timer() - operation_start)
+        else:
+            value = values[rng.randrange(len(values))]
+            operation_start = timer()
+            my_dict[key] = value
+            writes.append(timer() - operation_start)
+    elapsed = timer() - start
+
+    result = {'keys': number_of_keys, 'value_size': value_size,
+              'codec': codec, 'index_type': index_type,
+              'read_ratio': read_ratio,
+              'load': {'operations': number_of_keys, 'seconds': load_time,
+                       'throughput': number_of_keys / load_time
+                                     if load_time else None},
+              'mixed': summarize(reads + writes, elapsed),
+              'reads': summarize(reads, elapsed),
+              'writes': summarize(writes, elapsed),
+              'round_trips': my_dict.round_trips}
+    return result
+
 def main():
-    iterations = 10
-    tests = {'Python dict': 'test_pythondict()',
-             'Redis': 'test_redis()',
-             'MongoDict(safe=False)': 'test_mongodict(safe=False)',
-             'MongoDict(safe=True)': 'test_mongodict(safe=True)',
-    }
-    for test_name, function_call in tests.iteritems():
-        print test_name, timeit.timeit(function_call, test_code,
-                                       number=iterations)
-    #TODO: test for other number and sizes of keys/values
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=27017, type=int)
+    parser.add_argument('--database', default='mongodict_benchmark')
+    parser.add_argument('--keys', nargs='+', type=int, default=[1000, 10000],
+                        help='numbers of keys to store')
+    parser.add_argument('--value-sizes', nargs='+', type=int,
+                        default=[16, 1024, 65536],
+                        help='sizes of values (in bytes)')
+    parser.add_argument('--codecs', nargs='+',
+                        default=['pickle', 'json', 'bson'])
+    parser.add_argument('--index-types', nargs='+',
+                        default=['key', 'key-value'])
+    parser.add_argument('--read-ratios', nargs='+', type=float,
+                        default=[0.0, 0.5, 0.9, 1.0],
+                        help='fraction of operations which are reads')
+    parser.add_argument('--operations', type=int, default=None,
+                        help='operations per scenario (default: number of '
+                             'keys)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='JSON file (default: stdout)')
+    options = parser.parse_args()
+
+    results = []
+    for number_of_keys in options.keys:
+        for value_size in options.value_sizes:
+            for codec in options.codecs:
+                for index_type in options.index_types:
+                    for read_ratio in options.read_ratios:
+                        print('keys={} value_size={} codec={} index_type={} '
+                              'read_ratio={}'.format(number_of_keys,
+                                  value_size, codec, index_type, read_ratio),
+                              file=sys.stderr)
+                        try:
+                            result = run_scenario(options, number_of_keys,
+                                                  value_size, codec,
+                                                  index_type, read_ratio)
+                        except PyMongoError as exception:
+                            # e.g.: values too big for a `key-value` index
+                            result = {'keys': number_of_keys,
+                                      'value_size': value_size,
+                                      'codec': codec,
+                                      'index_type': index_type,
+                                      'read_ratio': read_ratio,
+                                      'error': str(exception)}
+                        results.append(result)
+    get_client(host=options.host, port=options.port)\
+            .drop_database(options.database)
+    close_clients()
+
+    report = {'mongodict': '.'.join(str(part) for part in __version__),
+              'pymongo': pymongo.version,
+              'python': platform.python_version(),
+              'date': datetime.datetime.utcnow().isoformat(),
+              'parameters': {'keys': options.keys,
+                             'value_sizes': options.value_sizes,
+                             'codecs': options.codecs,
+                             'index_types': options.index_types,
+                             'read_ratios': options.read_ratios,
+                             'operations': options.operations,
+                             'seed': options.seed},
+              'results': results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fobj:
+            fobj.write(output + '\n')
+    else:
+        print(output)
+
 
 if __name__ == '__main__':
     main()
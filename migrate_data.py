@@ -7,37 +7,316 @@ from 0.3.0 to 0.3.1.
 The first migration is needed since the new version uses another codec by
 default (pickle instead of JSON/BSON) and the later one because the key name
 changes on document (`value` to `v`).
+
+Big collections can be migrated in parallel (`--workers`): the `_id` space is
+split in ranges (all keys must have the same type, like strings) which are
+migrated by a pool of processes using bulk writes. `--max-rate` limits the
+total throughput (keys per second), so the servers can still serve the live
+traffic.
+
+The last migrated `_id` of each range is saved (after each bulk write) in a
+state document in the `mongodict_migrations` collection of the new database,
+so a crashed migration can continue with `--resume`. `--verify` compares the
+number of keys and a random sample of values of both collections.
 '''
 
+import argparse
 import datetime
+import multiprocessing
+import random
 import sys
 import time
 
 import mongodict
-import pymongo
+
+from pymongo.errors import PyMongoError
 
 
-encode_nothing = lambda x: x
-decode_nothing = lambda x: x
 report_template = ('\r{:010d} keys / {:010d} ({:6.2f}%) migrated. '
                    'Duration: {}, ETA: {}')
-REPORT_INTERVAL = 10 # in number of keys
+REPORT_INTERVAL = 1 # in seconds
+BATCH_SIZE = 1000 # keys per bulk write
+RANGES_PER_WORKER = 4 # so faster workers can help the slower ones
+STATE_COLLECTION = 'mongodict_migrations'
+VERIFY_SAMPLES = 1000
+_counter = None # shared between worker processes (see `_init_worker`)
 
 
-def print_report(counter, total, start_time):
-    percentual = 100 * (counter / float(total))
-    duration = datetime.timedelta((time.time() - start_time) / (24 * 3600))
+def print_report(counter, total, start_time, initial=0):
+    if total:
+        percentual = 100 * (counter / float(total))
+    else:
+        percentual = 100.0
+    elapsed = time.time() - start_time
+    duration = datetime.timedelta(elapsed / (24 * 3600))
     duration = str(duration).split('.')[0]
-    rate = counter / (time.time() - start_time)
-    eta = datetime.timedelta(((total - counter) / rate) / (24 * 3600))
-    eta = str(eta).split('.')[0]
+    if counter > initial and elapsed:
+        rate = (counter - initial) / elapsed
+        eta = datetime.timedelta((max(total - counter, 0) / rate) /
+                                 (24 * 3600))
+        eta = str(eta).split('.')[0]
+    else:
+        eta = '?'
     report = report_template.format(counter, total, percentual,
                                     duration, eta)
     sys.stdout.write(report)
     sys.stdout.flush()
 
 
-def migrate_codec(config_old, config_new):
+def convert_codec(new_dict, document):
+    return document['value']
+
+def convert_key(new_dict, document):
+    return new_dict.decode_value(document['value'])
+
+CONVERTERS = {'codec': convert_codec, 'key': convert_key}
+
+
+def get_collection(config):
+    client = mongodict.get_client(host=config['host'], port=config['port'])
+    return client[config['database']][config['collection']]
+
+
+def get_state_collection(config_new):
+    return get_collection(dict(config_new, collection=STATE_COLLECTION))
+
+
+def state_id(migration_type, config_old, config_new):
+    return '{}:{host}:{port}/{database}/{collection}->'.format(
+            migration_type, **config_old) + \
+           '{host}:{port}/{database}/{collection}'.format(**config_new)
+
+
+def split_id_space(collection, ranges):
+    '''Return up to `ranges` (lower, upper) `_id` bounds covering `collection`
+    `None` means no bound. Split points come from the `splitVector` command
+    (which only reads the `_id` index) or, if it's not available, from
+    walking over the index (see `ids_at_positions`).
+    '''
+    total = collection.count()
+    if ranges < 2 or total < ranges:
+        return [(None, None)]
+    keys_per_range = total // ranges
+    try:
+        result = collection.database.command('splitVector',
+                collection.full_name, keyPattern={'_id': 1},
+                maxChunkObjects=keys_per_range,
+                maxChunkSizeBytes=1024 ** 4)
+        split_points = [split_key['_id'] for split_key in result['splitKeys']]
+    except PyMongoError: # e.g.: not authorized
+        split_points = ids_at_positions(collection,
+                [number * keys_per_range for number in range(1, ranges)])
+    bounds = [None] + split_points + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def ids_at_positions(collection, positions):
+    '''Return the `_id`s at the (sorted) `positions` of the `_id` order
+    Only one cursor, returning just `_id`s, is walked (up to the last
+    position), instead of skipping from the start for each position.
+    '''
+    ids = []
+    positions = iter(positions)
+    wanted = next(positions, None)
+    if wanted is None:
+        return ids
+    cursor = collection.find({}, {'_id': 1}).sort('_id', 1)\
+                       .batch_size(BATCH_SIZE)
+    for position, document in enumerate(cursor):
+        if position == wanted:
+            ids.append(document['_id'])
+            wanted = next(positions, None)
+            if wanted is None:
+                break
+    cursor.close()
+    return ids
+
+
+def _init_worker(counter):
+    global _counter
+    _counter = counter
+
+
+def migrate_range(task):
+    '''Migrate the pairs with `lower <= _id < upper` using bulk writes
+    The range continues after its checkpoint (the last migrated `_id`), if
+    any. Return how many pairs were migrated.
+    '''
+    (migration_type, config_old, config_new, index, lower, upper, last,
+     batch_size, max_rate) = task
+    convert = CONVERTERS[migration_type]
+    collection = get_collection(config_old)
+    new_dict = mongodict.MongoDict(**config_new)
+    checkpoint = Checkpoint(get_state_collection(config_new),
+                            state_id(migration_type, config_old, config_new),
+                            index)
+    id_range = {}
+    if last is not None:
+        id_range['$gt'] = last
+    elif lower is not None:
+        id_range['$gte'] = lower
+    if upper is not None:
+        id_range['$lt'] = upper
+    spec = {'_id': id_range} if id_range else {}
+    cursor = collection.find(spec).sort('_id', 1).batch_size(batch_size)
+    start_time = time.time()
+    migrated = 0
+    batch = []
+    for document in cursor:
+        batch.append((document['_id'], convert(new_dict, document)))
+        if len(batch) >= batch_size:
+            migrated += write_batch(new_dict, batch, migrated, start_time,
+                                    max_rate, checkpoint)
+            batch = []
+    if batch:
+        migrated += write_batch(new_dict, batch, migrated, start_time,
+                                max_rate, checkpoint)
+    checkpoint.finish()
+    return migrated
+
+
+class Checkpoint(object):
+    '''Save the progress of one range in the migration state document'''
+
+    def __init__(self, collection, state_id, index):
+        self.collection = collection
+        self.state_id = state_id
+        self.prefix = 'ranges.{}.'.format(index)
+
+    def save(self, last, migrated):
+        self.collection.update({'_id': self.state_id},
+                               {'$set': {self.prefix + 'last': last},
+                                '$inc': {self.prefix + 'migrated': migrated}},
+                               w=1)
+
+    def finish(self):
+        self.collection.update({'_id': self.state_id},
+                               {'$set': {self.prefix + 'done': True}}, w=1)
+
+
+def write_batch(new_dict, batch, migrated, start_time, max_rate,
+                checkpoint=None):
+    # acknowledged, so the checkpoint never gets ahead of the data
+    new_dict.set_many(batch, batch_size=len(batch), write_concern={'w': 1})
+    if checkpoint is not None:
+        checkpoint.save(batch[-1][0], len(batch))
+    if _counter is not None:
+        with _counter.get_lock():
+            _counter.value += len(batch)
+    if max_rate:
+        # sleep until this worker's throughput is under its share
+        delay = (migrated + len(batch)) / float(max_rate) - \
+                (time.time() - start_time)
+        if delay > 0:
+            time.sleep(delay)
+    return len(batch)
+
+
+def start_state(migration_type, config_old, config_new, workers, resume):
+    '''Return the migration state document (a new one unless `resume`)'''
+    states = get_state_collection(config_new)
+    this_id = state_id(migration_type, config_old, config_new)
+    if resume:
+        state = states.find_one({'_id': this_id})
+        if state is None:
+            raise ValueError('There is no migration to resume.')
+        return state
+    ranges = split_id_space(get_collection(config_old),
+                            workers * RANGES_PER_WORKER if workers > 1 else 1)
+    state = {'_id': this_id, 'started': datetime.datetime.utcnow(),
+             'ranges': [{'lower': lower, 'upper': upper, 'last': None,
+                         'migrated': 0, 'done': False}
+                        for lower, upper in ranges]}
+    states.update({'_id': this_id}, state, upsert=True, w=1)
+    return state
+
+
+def migrate(migration_type, config_old, config_new, workers=1,
+            batch_size=BATCH_SIZE, max_rate=None, resume=False):
+    '''Migrate all pairs using a pool of `workers` processes
+    `max_rate` (keys per second) is shared by all workers. If `resume`,
+    continue the last migration with the same parameters from its
+    checkpoints (ranges are not split again).
+    '''
+    collection = get_collection(config_old)
+    total_pairs = collection.count()
+    state = start_state(migration_type, config_old, config_new, workers,
+                        resume)
+    worker_rate = max_rate / float(workers) if max_rate else None
+    tasks = [(migration_type, config_old, config_new, index, id_range['lower'],
+              id_range['upper'], id_range['last'], batch_size, worker_rate)
+             for index, id_range in enumerate(state['ranges'])
+             if not id_range['done']]
+    already_migrated = sum(id_range['migrated']
+                           for id_range in state['ranges'])
+    counter = multiprocessing.Value('l', already_migrated)
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(counter, ))
+    start_time = time.time()
+    try:
+        result = pool.map_async(migrate_range, tasks)
+        while not result.ready():
+            print_report(counter.value, total_pairs, start_time,
+                         already_migrated)
+            result.wait(REPORT_INTERVAL)
+        migrated = already_migrated + sum(result.get())
+    finally:
+        pool.close()
+        pool.join()
+    print_report(migrated, total_pairs, start_time, already_migrated)
+    print('')
+    get_state_collection(config_new).update({'_id': state['_id']},
+            {'$set': {'finished': datetime.datetime.utcnow()}}, w=1)
+    if migrated != total_pairs:
+        sys.stderr.write('Warning: {} keys migrated but {} were counted '
+                         'before starting.\n'.format(migrated, total_pairs))
+    return migrated
+
+
+def sample_documents(collection, size):
+    '''Return up to `size` random documents without reading all of them'''
+    try:
+        result = collection.aggregate([{'$sample': {'size': size}}])
+    except PyMongoError: # MongoDB < 3.2: pick random positions in the index
+        total = collection.count()
+        offsets = set()
+        while len(offsets) < min(size, total):
+            offsets.add(random.randrange(total))
+        ids = ids_at_positions(collection, sorted(offsets))
+        documents = []
+        for start in range(0, len(ids), BATCH_SIZE):
+            documents.extend(collection.find(
+                    {'_id': {'$in': ids[start:start + BATCH_SIZE]}}))
+        return documents
+    if isinstance(result, dict): # pymongo < 3
+        return result['result']
+    return list(result)
+
+
+def verify(migration_type, config_old, config_new, samples=VERIFY_SAMPLES):
+    '''Compare key counts and `samples` random values of both collections
+    Return True if nothing differs.
+    '''
+    convert = CONVERTERS[migration_type]
+    collection = get_collection(config_old)
+    new_dict = mongodict.MongoDict(**config_new)
+    old_total, new_total = collection.count(), len(new_dict)
+    print('Keys: {} (old), {} (new)'.format(old_total, new_total))
+    documents = sample_documents(collection, samples)
+    new_values = new_dict.get_many(document['_id'] for document in documents)
+    missing, different = 0, 0
+    for document in documents:
+        key = document['_id']
+        if key not in new_values:
+            missing += 1
+        elif new_values[key] != convert(new_dict, document):
+            different += 1
+    print('Sampled values: {}, missing: {}, different: {}'.format(
+          len(documents), missing, different))
+    return old_total == new_total and not missing and not different
+
+
+def migrate_codec(config_old, config_new, **kwargs):
     '''Migrate data from mongodict <= 0.2.1 to 0.3.0
     `config_old` and `config_new` should be dictionaries with the keys
     regarding to MongoDB server:
@@ -45,25 +324,14 @@ def migrate_codec(config_old, config_new):
         - `port`
         - `database`
         - `collection`
+    `kwargs` are passed to `migrate` (`workers`, `batch_size`, `max_rate`,
+    `resume`).
     '''
     assert mongodict.__version__ in [(0, 3, 0), (0, 3, 1)]
+    # new dict uses pickle codec by default
+    return migrate('codec', config_old, config_new, **kwargs)
 
-    connection = pymongo.Connection(host=config_old['host'],
-                                    port=config_old['port'])
-    database = connection[config_old['database']]
-    collection = database[config_old['collection']]
-    new_dict = mongodict.MongoDict(**config_new) # uses pickle codec by default
-    total_pairs = collection.count()
-    start_time = time.time()
-    for counter, pair in enumerate(collection.find(), start=1):
-        key, value = pair['_id'], pair['value']
-        new_dict[key] = value
-        if counter % REPORT_INTERVAL == 0:
-            print_report(counter, total_pairs, start_time)
-    print_report(counter, total_pairs, start_time)
-    print('')
-
-def migrate_key(config_old, config_new):
+def migrate_key(config_old, config_new, **kwargs):
     '''Migrate data from mongodict == 0.3.0 to 0.3.1
     `config_old` and `config_new` should be dictionaries with the keys
     regarding to MongoDB server:
@@ -71,23 +339,12 @@ def migrate_key(config_old, config_new):
         - `port`
         - `database`
         - `collection`
+    `kwargs` are passed to `migrate` (`workers`, `batch_size`, `max_rate`,
+    `resume`).
     '''
     assert mongodict.__version__ == (0, 3, 1)
-
-    connection = pymongo.Connection(host=config_old['host'],
-                                    port=config_old['port'])
-    database = connection[config_old['database']]
-    collection = database[config_old['collection']]
-    new_dict = mongodict.MongoDict(**config_new) # uses `v` as default key
-    total_pairs = collection.count()
-    start_time = time.time()
-    for counter, pair in enumerate(collection.find(), start=1):
-        key, value = pair['_id'], new_dict.decode_value(pair['value'])
-        new_dict[key] = value
-        if counter % REPORT_INTERVAL == 0:
-            print_report(counter, total_pairs, start_time)
-    print_report(counter, total_pairs, start_time)
-    print('')
+    # new dict uses `v` as default key
+    return migrate('key', config_old, config_new, **kwargs)
 
 
 def parse_mongo_data(data_as_string):
@@ -102,28 +359,54 @@ def main():
         sys.stderr.write('You need mongodict >= 0.3.0 to run this script.\n')
         exit(1)
 
-    if len(sys.argv) < 4:
-        error_message = ('ERROR: usage: {} <old host:port/db/coll> '
-                         '<new host:port/db/coll> <codec|key>\n').format(sys.argv[0])
-        sys.stderr.write(error_message)
-        exit(2)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('old', help='old host:port/db/coll')
+    parser.add_argument('new', help='new host:port/db/coll')
+    parser.add_argument('migration_type', choices=['codec', 'key'])
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='keys per bulk write')
+    parser.add_argument('--max-rate', type=float, default=None,
+                        help='maximum keys migrated per second (all workers)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the last migration from its '
+                             'checkpoints')
+    parser.add_argument('--verify', action='store_true',
+                        help='compare counts and sampled values after '
+                             'migrating')
+    parser.add_argument('--verify-only', action='store_true',
+                        help='only compare (do not migrate)')
+    parser.add_argument('--samples', type=int, default=VERIFY_SAMPLES,
+                        help='number of values to compare')
+    args = parser.parse_args()
 
     try:
-        old_config = parse_mongo_data(sys.argv[1])
-        new_config = parse_mongo_data(sys.argv[2])
-    except IndexError:
+        old_config = parse_mongo_data(args.old)
+        new_config = parse_mongo_data(args.new)
+    except (IndexError, ValueError):
         sys.stderr.write('Error parsing MongoDB server data. Please check.\n')
         exit(3)
-    migration_type = sys.argv[3]
-    if migration_type not in ('codec', 'key'):
-        sys.stderr.write('Invalid migration type: {}'.format(migration_type))
-        exit(4)
-
-    print('Starting migration...')
-    if migration_type == 'codec':
-        migrate_codec(old_config, new_config)
-    elif migration_type == 'key':
-        migrate_key(old_config, new_config)
+
+    if not args.verify_only:
+        print('Resuming migration...' if args.resume
+              else 'Starting migration...')
+        options = {'workers': args.workers, 'batch_size': args.batch_size,
+                   'max_rate': args.max_rate, 'resume': args.resume}
+        try:
+            if args.migration_type == 'codec':
+                migrate_codec(old_config, new_config, **options)
+            elif args.migration_type == 'key':
+                migrate_key(old_config, new_config, **options)
+        except ValueError as exception:
+            sys.stderr.write('Error: {}\n'.format(exception))
+            exit(4)
+    if args.verify or args.verify_only:
+        print('Verifying...')
+        if not verify(args.migration_type, old_config, new_config,
+                      args.samples):
+            sys.stderr.write('Verification failed.\n')
+            exit(5)
 
 
 if __name__ == '__main__':
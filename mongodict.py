@@ -15,72 +15,1365 @@ As it uses `MongoDB <http://mongodb.org/>`_ to store the data, you get all cool
 `Python 3.2 <http://www.python.org/getit/releases/3.2/>`_.
 '''
 
+import bisect
+import bz2
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import marshal
+import os
 import sys
+import threading
+import time
+import weakref
+import zlib
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
+try:
+    import lzma
+except ImportError: # Python 2
+    lzma = None
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
 
-from collections import MutableMapping
+from collections import (ItemsView, Mapping, MutableMapping, OrderedDict,
+                         ValuesView)
 
 import pymongo
 
-from bson import Binary
+from bson import Binary, ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 
 
 __version__ = (0, 3, 1)
-__all__ = ['MongoDict']
+__all__ = ['MongoDict', 'ShardedMongoDict', 'VersionConflict', 'get_client',
+           'close_clients', 'register_codec']
 INDEX_KEY = [('_id', 1)]
 INDEX_KEY_VALUE = [('_id', 1), ('v', 1)]
+MAX_KEYS_PER_QUERY = 1000
+MAX_BYTES_PER_QUERY = 8 * 1024 * 1024 # half of BSON's 16MB document limit
+BULK_BATCH_SIZE = 1000
+OPLOG_REPLAY = 8 # cursor option to efficiently find `ts` in the oplog
+MAX_POOL_SIZE = 100
+ITER_BATCH_SIZE = 1000
+VALUE_FIELDS = {'v': 1, 'c': 1, 'z': 1, 'k': 1, 'l': 1, 'e': 1, 'r': 1}
+KEY_FIELDS = {'_id': 1, 'e': 1}
+DOCUMENT_FIELDS = ('v', 'c', 'z', 'k', 'l', 'e') # all but `_id` and `r`
+TTL_INDEX = [('e', 1)]
+COMPRESSION_THRESHOLD = 1024 # in bytes
+CHUNK_THRESHOLD = 15 * 1024 * 1024 # leaves room for key and metadata
+CHUNK_SIZE = 255 * 1024 # same as GridFS
+CHUNKS_PER_INSERT = 16
+CHUNK_INDEXES = ([('s', 1), ('n', 1)], [('f', 1)])
+SHARD_REPLICAS = 100 # points of each shard in the hash ring
+READ_PREFERENCES = ('primary', 'primary_preferred', 'secondary',
+                    'secondary_preferred', 'nearest')
+STALENESS_CHECK_INTERVAL = 10 # seconds between replication lag checks
+WRITE_CONCERN_OPTIONS = ('w', 'j', 'wtimeout')
+DUPLICATE_KEY_ERRORS = (11000, 11001)
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PARALLEL_QUEUE_SIZE = 1000
+INVALIDATION_HISTORY = 10000 # invalidated keys remembered by `LRUCache`
 
 if sys.version_info[0] == 2:
     binary_type = str
+    text_type = unicode
+    integer_types = (int, long)
+    unichr = unichr
 else:
     binary_type = bytes
+    text_type = str
+    integer_types = (int, )
+    unichr = chr
+
+try:
+    process_time = time.process_time # CPU time of the process
+except AttributeError: # Python 2
+    process_time = time.clock
+
+_MISSING = object()
+_DELETED = object()
+_clients = {}
+_indexes = set()
+_registry_lock = threading.Lock()
 
 def pickle_dumps(value):
     return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
 
+def json_dumps(value):
+    return json.dumps(value).encode('utf-8')
+
+def json_loads(value):
+    return json.loads(value.decode('utf-8'))
+
+def raw_dumps(value):
+    if not isinstance(value, binary_type):
+        raise TypeError(u'Error: `raw` codec only stores bytes')
+    return value
+
+def raw_loads(value):
+    return value
+
+# `bson` is special: values BSON can store natively are stored as is (others
+# use `pickle`), so it does not have functions here
+CODECS = {'pickle': (pickle_dumps, pickle.loads),
+          'marshal': (marshal.dumps, marshal.loads),
+          'json': (json_dumps, json_loads),
+          'raw': (raw_dumps, raw_loads),}
+
+# name: (compress, decompress, incremental decompressor factory)
+COMPRESSORS = {'zlib': (zlib.compress, zlib.decompress, zlib.decompressobj),
+               'bz2': (bz2.compress, bz2.decompress, bz2.BZ2Decompressor),}
+if lzma is not None:
+    COMPRESSORS['lzma'] = (lzma.compress, lzma.decompress,
+                           lzma.LZMADecompressor)
+
+def register_codec(name, encode, decode):
+    ''' Register a named codec, usable as ``MongoDict(codec=name)``
+
+    ``encode`` must return bytes and ``decode`` receives bytes. The name is
+    stored in each document, so it must not change while there is data
+    encoded with it.
+    '''
+    if name == 'bson':
+        raise ValueError(u'Error: `bson` codec can not be replaced')
+    CODECS[name] = (encode, decode)
+
+def _get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(u'Error: unknown codec {!r}'.format(name))
+
+def _is_bson_native(value):
+    ''' Return True if BSON stores and retrieves ``value`` without changes '''
+    value_type = type(value)
+    if value_type in integer_types:
+        return -2 ** 63 <= value < 2 ** 63
+    return value_type in (text_type, float, bool, type(None))
+
+def _value_size(value):
+    if isinstance(value, (binary_type, text_type)):
+        return len(value)
+    return 8
+
+def _document_size(document):
+    if 'k' in document:
+        return document['l']
+    return _value_size(document['v'])
+
+def _is_expired(document, now=None):
+    ''' Return True if ``document`` expired (but was not removed yet) '''
+    if document.get('e') is None:
+        return False
+    return document['e'] <= (now or datetime.datetime.utcnow())
+
+def _not_expired(documents):
+    now = datetime.datetime.utcnow()
+    return (document for document in documents
+            if not _is_expired(document, now))
+
+def _get_compressor(name):
+    try:
+        return COMPRESSORS[name]
+    except KeyError:
+        raise ValueError(u'Error: unknown compression {!r}'.format(name))
+
+def _decompress_pieces(pieces, algorithm):
+    decompressor = _get_compressor(algorithm)[2]()
+    for piece in pieces:
+        yield decompressor.decompress(piece)
+    if hasattr(decompressor, 'flush'):
+        yield decompressor.flush()
+
+class StreamingItemsView(ItemsView):
+    ''' ``ItemsView`` that reads keys and values using only one cursor '''
+
+    def __init__(self, mapping, batch_size=ITER_BATCH_SIZE):
+        super(StreamingItemsView, self).__init__(mapping)
+        self._batch_size = batch_size
+
+    def __iter__(self):
+        return self._mapping.iteritems(self._batch_size)
+
+class StreamingValuesView(ValuesView):
+    ''' ``ValuesView`` that reads values using only one cursor '''
+
+    def __init__(self, mapping, batch_size=ITER_BATCH_SIZE):
+        super(StreamingValuesView, self).__init__(mapping)
+        self._batch_size = batch_size
+
+    def __iter__(self):
+        return self._mapping.itervalues(self._batch_size)
+
+    def __contains__(self, value):
+        for stored_value in self:
+            if stored_value is value or stored_value == value:
+                return True
+        return False
+
+class ValueReader(io.RawIOBase):
+    ''' Read-only file-like object over an iterator of byte strings '''
+
+    def __init__(self, pieces):
+        super(ValueReader, self).__init__()
+        self._pieces = iter(pieces)
+        self._current = b''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._offset >= len(self._current):
+            try:
+                self._current = next(self._pieces)
+            except StopIteration:
+                return 0
+            self._offset = 0
+        size = min(len(buffer), len(self._current) - self._offset)
+        buffer[:size] = self._current[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+def get_client(host='localhost', port=27017, database=None, auth=None,
+               max_pool_size=MAX_POOL_SIZE, connect_timeout=None,
+               socket_timeout=None, replica_set=None):
+    ''' Return the process-wide pooled ``MongoClient`` for these options
+
+    Clients are created (and authenticated on `database`, if `auth` is
+    provided) only once and shared by all ``MongoDict`` objects using the
+    same options. Timeouts are in seconds.
+    If `replica_set` (its name) is provided, a ``MongoReplicaSetClient`` is
+    returned (it's needed to read from secondaries); `host` can then be a
+    list of members (like ``'host1:27017,host2:27017'``).
+    '''
+    if auth is not None:
+        auth = tuple(auth)
+    else:
+        database = None # only authentication depends on the database
+    # forked processes can't share sockets with their parent
+    key = (os.getpid(), host, port, database, auth, max_pool_size,
+           connect_timeout, socket_timeout, replica_set)
+    with _registry_lock:
+        client = _clients.get(key)
+        if client is None:
+            options = {'max_pool_size': max_pool_size}
+            if connect_timeout is not None:
+                options['connectTimeoutMS'] = int(connect_timeout * 1000)
+            if socket_timeout is not None:
+                options['socketTimeoutMS'] = int(socket_timeout * 1000)
+            if replica_set is None:
+                client = pymongo.MongoClient(host=host, port=port, **options)
+            else:
+                if ':' not in host and ',' not in host:
+                    host = u'{}:{}'.format(host, port)
+                client = pymongo.MongoReplicaSetClient(host,
+                                                       replicaSet=replica_set,
+                                                       **options)
+            if auth is not None:  # TODO: test auth
+                if not client[database].authenticate(*auth):
+                    client.disconnect()
+                    raise ValueError('Cannot authenticate to MongoDB server.')
+            _clients[key] = client
+    return client
+
+def close_clients():
+    ''' Disconnect all clients created by ``get_client`` '''
+    with _registry_lock:
+        for client in _clients.values():
+            client.disconnect()
+        _clients.clear()
+        _indexes.clear()
+
+def _ensure_index(collection, index, **kwargs):
+    ''' Create ``index`` only once per process (and per client) '''
+    key = (id(collection.database.connection), collection.full_name,
+           tuple(index), tuple(sorted(kwargs.items())))
+    if key not in _indexes:
+        collection.ensure_index(index, **kwargs)
+        _indexes.add(key)
+
+def _key_size(key):
+    if isinstance(key, text_type):
+        return len(key.encode('utf-8'))
+    elif isinstance(key, binary_type):
+        return len(key)
+    return 16
+
+def _iter_pairs(other, kwargs=None):
+    ''' Iterate over (key, value) pairs the same way ``dict.update`` does '''
+    if isinstance(other, Mapping):
+        for key in other:
+            yield key, other[key]
+    elif hasattr(other, 'keys'):
+        for key in other.keys():
+            yield key, other[key]
+    else:
+        for key, value in other:
+            yield key, value
+    if kwargs:
+        for key, value in kwargs.items():
+            yield key, value
+
+def _prefix_range(prefix):
+    ''' Return a ``$gte``/``$lt`` query matching the keys with ``prefix``
+
+    MongoDB compares strings by their UTF-8 bytes (which is the same as
+    comparing code points), so the upper bound is the prefix with its last
+    code point incremented. On Python 3 ``bytes`` keys are stored as BSON
+    binary (not strings), so ``bytes`` prefixes are rejected.
+    '''
+    if isinstance(prefix, binary_type):
+        if sys.version_info[0] > 2:
+            raise ValueError(u'Error: prefix must be a string, not bytes')
+        prefix = prefix.decode('utf-8')
+    bound = prefix
+    while bound:
+        code_point = ord(bound[-1]) + 1
+        if 0xd800 <= code_point <= 0xdfff: # surrogates can't be encoded
+            code_point = 0xe000
+        if code_point <= sys.maxunicode:
+            return {'$gte': prefix, '$lt': bound[:-1] + unichr(code_point)}
+        bound = bound[:-1]
+    return {'$gte': prefix}
+
+def _in_key_range(key, key_range):
+    if isinstance(key, binary_type):
+        try:
+            key = key.decode('utf-8')
+        except UnicodeDecodeError:
+            return False
+    if not isinstance(key, text_type):
+        return False
+    return key >= key_range['$gte'] and \
+           ('$lt' not in key_range or key < key_range['$lt'])
+
+def _split_keys(keys, max_keys=MAX_KEYS_PER_QUERY,
+                max_bytes=MAX_BYTES_PER_QUERY):
+    ''' Split ``keys`` in batches small enough to fit in one query '''
+    batch, batch_bytes = [], 0
+    for key in keys:
+        key_bytes = _key_size(key)
+        if batch and (len(batch) >= max_keys or
+                      batch_bytes + key_bytes > max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(key)
+        batch_bytes += key_bytes
+    if batch:
+        yield batch
+
+def _key_hash(key):
+    ''' Return a stable (across processes) integer hash for ``key`` '''
+    if isinstance(key, text_type):
+        key = key.encode('utf-8')
+    elif not isinstance(key, binary_type):
+        key = text_type(key).encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+def _run_parallel(function, items):
+    ''' Return ``[function(item) for item in items]``, one thread per item
+
+    If any call raises an exception, the first one is re-raised after all
+    threads finish.
+    '''
+    items = list(items)
+    if len(items) < 2:
+        return [function(item) for item in items]
+    results = [None] * len(items)
+    errors = []
+
+    def run(index, item):
+        try:
+            results[index] = function(item)
+        except Exception as exception:
+            errors.append(exception)
+
+    threads = [threading.Thread(target=run, args=(index, item))
+               for index, item in enumerate(items)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+def _iter_parallel(iterables, queue_size=PARALLEL_QUEUE_SIZE):
+    ''' Iterate over all ``iterables`` at the same time, one thread each
+
+    Items are yielded as they arrive (in no particular order). If the
+    iteration stops early, the threads stop too.
+    '''
+    iterables = list(iterables)
+    items = queue.Queue(queue_size)
+    stop = threading.Event()
+    finished = _MISSING
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def run(iterable):
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as exception:
+            put((finished, exception))
+        else:
+            put((finished, None))
+
+    threads = [threading.Thread(target=run, args=(iterable, ))
+               for iterable in iterables]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    running = len(threads)
+    try:
+        while running:
+            item, error = items.get()
+            if item is not finished:
+                yield item
+                continue
+            running -= 1
+            if error is not None:
+                raise error
+    finally:
+        stop.set()
+
+def _get_read_preference(name):
+    if name not in READ_PREFERENCES:
+        raise ValueError(u'Error: unknown read preference')
+    return getattr(pymongo.ReadPreference, name.upper())
+
+def _replication_lag(client):
+    ''' Return the lag (in seconds) of the most outdated secondary
+
+    Return ``None`` if there are no secondaries.
+    '''
+    members = client.admin.command('replSetGetStatus')['members']
+    primary = [member['optimeDate'] for member in members
+               if member['stateStr'] == 'PRIMARY']
+    secondaries = [member['optimeDate'] for member in members
+                   if member['stateStr'] == 'SECONDARY']
+    if not primary or not secondaries:
+        return None
+    return max((primary[0] - optime).total_seconds()
+               for optime in secondaries)
+
+def _check_write_concern(options):
+    for option in options:
+        if option not in WRITE_CONCERN_OPTIONS:
+            raise ValueError(u'Error: unknown write concern option')
+    return dict(options)
+
+def _not_expired_spec(key, now):
+    ''' Return the spec matching ``key`` only if it did not expire '''
+    return {'_id': key, '$or': [{'e': None}, {'e': {'$gt': now}}]}
+
+def _increment_spec(delta):
+    ''' Return the update which adds ``delta`` to a (BSON) counter '''
+    return {'$inc': {'v': delta, 'r': 1}, '$set': {'c': 'bson'}}
+
+class VersionConflict(Exception):
+    ''' Raised by ``MongoDict.update_with`` if it runs out of retries '''
+
+def _update_spec(document):
+    ''' Return the update (with version increment) that stores ``document``
+
+    A replacement document can't increment the version, so we ``$set`` its
+    fields and ``$unset`` the ones it doesn't have.
+    '''
+    spec = {'$set': dict((field, value) for field, value in document.items()
+                         if field != '_id'),
+            '$inc': {'r': 1}}
+    missing = dict((field, '') for field in DOCUMENT_FIELDS
+                   if field not in document)
+    if missing:
+        spec['$unset'] = missing
+    return spec
+
+class LRUCache(object):
+    ''' Least-recently-used cache limited by entry count and/or byte size '''
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+        # key: (generation, version) of its last invalidation
+        self._invalidated = OrderedDict()
+        self._forgotten = 0 # last generation dropped from `_invalidated`
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        ''' Return the cached value or ``_MISSING`` (updating counters) '''
+        with self._lock:
+            try:
+                entry = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return _MISSING
+            value, size, expires, version = entry
+            if expires is not None and expires <= datetime.datetime.utcnow():
+                self.size -= size
+                self.misses += 1
+                return _MISSING
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size, generation=None, expires=None,
+            version=None):
+        ''' Cache ``value`` (until ``expires``, a UTC ``datetime``, if given)
+
+        ``version`` is the version of the document (if known). If
+        ``generation`` (the one before reading the value) is provided and
+        ``key`` was invalidated since then (by an older version), the value
+        may be stale and is not cached.
+        '''
+        with self._lock:
+            if generation is not None and \
+               self._is_stale(key, generation, version):
+                return
+            self._discard(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = (value, size, expires, version)
+            self.size += size
+            while (self.max_entries is not None and
+                       len(self._data) > self.max_entries) or \
+                  (self.max_bytes is not None and self.size > self.max_bytes):
+                old_key, old_entry = self._data.popitem(last=False)
+                self.size -= old_entry[1]
+                self.evictions += 1
+
+    def _is_stale(self, key, generation, version):
+        if self._forgotten > generation:
+            return True # we don't know which keys were invalidated
+        invalidation = self._invalidated.get(key)
+        if invalidation is None or invalidation[0] <= generation:
+            return False
+        # changed after it was read, but the read may have seen the change
+        new_version = invalidation[1]
+        return version is None or new_version is None or version < new_version
+
+    def _discard(self, key):
+        if key in self._data:
+            self.size -= self._data.pop(key)[1]
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def discard_matching(self, predicate):
+        ''' Discard all keys for which ``predicate(key)`` is true '''
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                self._discard(key)
+
+    def invalidate(self, key=_MISSING, version=None):
+        ''' Discard ``key`` (or everything) because it changed elsewhere
+
+        Only values read before the change are affected: if ``version`` (the
+        new version of the document) is provided, a cached value with this
+        version (or a newer one) is kept.
+        '''
+        with self._lock:
+            self.generation += 1
+            if key is _MISSING:
+                self._data.clear()
+                self.size = 0
+                self._invalidated.clear()
+                self._forgotten = self.generation
+                return
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = (self.generation, version)
+            if len(self._invalidated) > INVALIDATION_HISTORY:
+                old_key, (old_generation, old_version) = \
+                        self._invalidated.popitem(last=False)
+                self._forgotten = old_generation
+            entry = self._data.get(key)
+            if entry is not None and (version is None or entry[3] is None or
+                                      entry[3] < version):
+                self._discard(key)
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self._data),
+                'bytes': self.size}
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and \
+               (entry[2] is None or entry[2] > datetime.datetime.utcnow())
+
+    def __len__(self):
+        return len(self._data)
+
+class OperationStats(object):
+    ''' Call counters and latency histograms of ``MongoDict`` operations '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.operations = {}
+            self.counters = {'encoded': 0, 'decoded': 0, 'bytes_sent': 0,
+                             'bytes_received': 0, 'encode_time': 0.0,
+                             'decode_time': 0.0}
+
+    def record(self, operation, seconds, error=False):
+        ''' Count one call of ``operation`` which took ``seconds`` '''
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = \
+                        {'calls': 0, 'errors': 0, 'time': 0.0,
+                         'max_time': 0.0,
+                         'histogram': [0] * (len(self.buckets) + 1)}
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['time'] += seconds
+            stats['max_time'] = max(stats['max_time'], seconds)
+            stats['histogram'][bucket] += 1
+
+    def add(self, **counters):
+        ''' Add values to the (encoding/decoding) counters '''
+        with self._lock:
+            for name, value in counters.items():
+                self.counters[name] += value
+
+    def info(self):
+        with self._lock:
+            info = dict(self.counters)
+            info['operations'] = dict((operation,
+                                       dict(stats,
+                                            histogram=list(stats['histogram'])))
+                                      for operation, stats
+                                      in self.operations.items())
+        info['buckets'] = list(self.buckets)
+        return info
+
+def _updated_version(update):
+    ''' Return the version stored by an oplog update (``None`` if unknown) '''
+    if 'r' in update: # replacement document
+        return update['r']
+    if 'diff' in update: # MongoDB 5.0+
+        return update['diff'].get('u', {}).get('r')
+    return update.get('$set', {}).get('r') # `$inc` is logged as `$set`
+
+class BufferFlusher(object):
+    ''' Flush the write-behind buffer of a ``MongoDict`` when it gets old
+
+    The thread keeps only a weak reference to the dict, so the dict can
+    still be collected (and flushed by ``__del__``).
+    '''
+
+    def __init__(self, my_dict, timeout):
+        self.timeout = timeout
+        self._dict = weakref.ref(my_dict)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and \
+           self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            my_dict = self._dict()
+            if my_dict is None:
+                return
+            delay = my_dict._flush_old_writes()
+            del my_dict
+            self._stop.wait(delay)
+
+class CacheInvalidator(object):
+    ''' Keep a ``LRUCache`` coherent with writes made by other processes
+
+    Tails the replica set oplog (so it needs a replica set, even if a
+    single-node one) and invalidates cached keys as soon as their documents
+    change. Values cached before it starts and changes made while the oplog
+    cursor is lost (network errors, oplog rollover) may have been missed, so
+    the whole cache is invalidated every time it starts tailing from the end
+    of the oplog.
+    '''
+
+    def __init__(self, cache, collection, retry_interval=1):
+        self.cache = cache
+        self.retry_interval = retry_interval
+        self._namespace = collection.full_name
+        self._collection_name = collection.name
+        self._database_name = collection.database.name
+        self._oplog = collection.database.connection['local']['oplog.rs']
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and \
+           self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _last_timestamp(self):
+        entries = list(self._oplog.find({}, {'ts': 1})\
+                                  .sort('$natural', -1).limit(1))
+        return entries[0]['ts'] if entries else None
+
+    def _query(self, timestamp):
+        ''' Return the query for oplog entries which may change the cache
+
+        These are the writes to the collection and the commands which drop
+        or rename it (or its database).
+        '''
+        commands = '{}.$cmd'.format(self._database_name)
+        query = {'$or': [{'ns': self._namespace},
+                         {'ns': commands, 'o.drop': self._collection_name},
+                         {'ns': commands, 'o.dropDatabase': {'$exists': True}},
+                         {'ns': 'admin.$cmd',
+                          'o.renameCollection': self._namespace},
+                         {'ns': 'admin.$cmd', 'o.to': self._namespace}]}
+        if timestamp is not None:
+            query['ts'] = {'$gt': timestamp}
+        return query
+
+    def _run(self):
+        timestamp = None
+        while not self._stop.is_set():
+            try:
+                if timestamp is None:
+                    timestamp = self._last_timestamp()
+                    # anything before this point may be cached
+                    self.cache.invalidate()
+                cursor = self._oplog.find(self._query(timestamp),
+                                          tailable=True, await_data=True)\
+                                    .add_option(OPLOG_REPLAY)
+                while cursor.alive and not self._stop.is_set():
+                    for entry in cursor:
+                        timestamp = entry['ts']
+                        self.handle(entry)
+                        if self._stop.is_set():
+                            break
+                if not self._stop.is_set():
+                    # cursor is dead: we can't be sure nothing was missed
+                    self.cache.invalidate()
+                    timestamp = None
+            except PyMongoError:
+                self.cache.invalidate()
+                timestamp = None
+                self._stop.wait(self.retry_interval)
+
+    def handle(self, entry):
+        ''' Invalidate the cache according to one oplog entry '''
+        operation = entry['op']
+        if operation == 'i':
+            self.cache.invalidate(entry['o']['_id'], entry['o'].get('r'))
+        elif operation == 'u':
+            self.cache.invalidate(entry['o2']['_id'],
+                                  _updated_version(entry['o']))
+        elif operation == 'd':
+            self.cache.invalidate(entry['o']['_id'])
+        elif operation != 'n':
+            # commands (like collection drops) may change everything
+            self.cache.invalidate()
+
 class MongoDict(MutableMapping):
     ''' ``dict``-like interface for storing data in MongoDB '''
 
 
     def __init__(self, host='localhost', port=27017, database='mongodict',
                  collection='main', codec=(pickle_dumps, pickle.loads),
-                 safe=True, auth=None, default=None, index_type='key'):
+                 safe=True, auth=None, default=None, index_type='key',
+                 buffer_size=None, buffer_timeout=None, cache_size=None,
+                 cache_bytes=None, max_pool_size=MAX_POOL_SIZE,
+                 connect_timeout=None, socket_timeout=None, compression=None,
+                 compression_threshold=COMPRESSION_THRESHOLD,
+                 chunk_threshold=CHUNK_THRESHOLD, chunk_size=CHUNK_SIZE,
+                 approximate_len=False, len_cache_ttl=None, ttl=None,
+                 replica_set=None, read_preference='primary',
+                 max_staleness=None, write_concern=None, collect_stats=False):
         ''' MongoDB-backed Python ``dict``-like interface
 
-        Create a new MongoDB connection.
-        `auth` must be (login, password)'''
+        `codec` can be a (serializer, deserializer) tuple or the name of a
+        registered codec (`pickle`, `marshal`, `json`, `raw`, `bson` or any
+        other added by `register_codec`). Named codecs are stored in each
+        document, so different codecs can share a collection (documents
+        without a codec name, written with the default codec, are read with
+        `pickle`). The `bson` codec stores values natively when BSON supports
+        them (unicode, integers, floats, booleans and ``None``) and uses
+        `pickle` otherwise.
+        If `compression` (`zlib`, `bz2` or `lzma`) is provided, encoded values
+        with at least `compression_threshold` bytes are compressed (the
+        algorithm is stored in the document, so documents with and without
+        compression can be read together).
+        Encoded values bigger than `chunk_threshold` bytes are split in
+        chunks of `chunk_size` bytes, stored in the `<collection>.chunks`
+        collection (like GridFS does), so they are not limited by MongoDB's
+        16MB document size.
+        If `approximate_len`, ``len`` uses the collection metadata (fast, but
+        may be inaccurate, mainly on sharded clusters). If `len_cache_ttl`
+        (seconds) is provided, ``len`` returns a cached count which is kept
+        up to date by the writes of this object and is refreshed from the
+        server after `len_cache_ttl` seconds.
+        If `ttl` (seconds) is provided, keys written by this object expire
+        after `ttl` seconds by default (see `set`).
+        Connections come from a process-wide pool shared by all objects with
+        the same `host`, `port`, `auth`, `max_pool_size`, `connect_timeout`
+        and `socket_timeout` (timeouts in seconds), see `get_client`.
+        If `replica_set` (its name) is provided, reads use
+        `read_preference` (`primary`, `primary_preferred`, `secondary`,
+        `secondary_preferred` or `nearest`); writes always go to the primary.
+        If `max_staleness` (seconds) is provided, reads go to the primary
+        while any secondary lags more than it (the lag is checked every
+        ``STALENESS_CHECK_INTERVAL`` seconds).
+        `write_concern` is a ``dict`` with `w`, `j` and/or `wtimeout` (in
+        milliseconds) used by all writes (it replaces `safe`, which means
+        ``{'w': 1}`` if True or ``{'w': 0}`` otherwise). It can be changed
+        for one call (the `write_concern` parameter of ``set``, ``set_many``
+        and ``compare_and_set``) or for a block (see ``write_concern``).
+        `auth` must be (login, password)
+        If `buffer_size` (number of keys) and/or `buffer_timeout` (seconds)
+        are provided, writes are buffered in memory (write-behind) and sent
+        as one bulk write when one of the limits is reached or when `flush`
+        is called. With `buffer_timeout`, a thread flushes the buffer when
+        its oldest write gets older than the limit, even if writes stop.
+        If `cache_size` (number of keys) and/or `cache_bytes` are provided,
+        decoded values are kept in an in-process LRU cache. The byte size of
+        a value is estimated by its encoded size. Cached values are shared
+        between lookups, so do not change them in place.
+        `round_trips` counts the requests sent to the server by this object
+        (a cursor counts as one request).
+        If `collect_stats`, mapping operations are measured (see ``stats``).
+        The object is fork-safe (it reconnects in the child process) and
+        pickles to its configuration only (not its data).'''
         super(MongoDict, self).__init__()
-        self._connection = pymongo.Connection(host=host, port=port, safe=safe)
-        self._safe = safe
-        self._db = self._connection[database]
-        if auth is not None:  # TODO: test auth
-            if not self._db.authenticate(*auth):
-                raise ValueError('Cannot authenticate to MongoDB server.')
-        self._collection = self._db[collection]
+        self._config = {'host': host, 'port': port, 'database': database,
+                        'collection': collection, 'codec': codec,
+                        'safe': safe, 'auth': auth, 'index_type': index_type,
+                        'buffer_size': buffer_size,
+                        'buffer_timeout': buffer_timeout,
+                        'cache_size': cache_size, 'cache_bytes': cache_bytes,
+                        'max_pool_size': max_pool_size,
+                        'connect_timeout': connect_timeout,
+                        'socket_timeout': socket_timeout,
+                        'compression': compression,
+                        'compression_threshold': compression_threshold,
+                        'chunk_threshold': chunk_threshold,
+                        'chunk_size': chunk_size,
+                        'approximate_len': approximate_len,
+                        'len_cache_ttl': len_cache_ttl, 'ttl': ttl,
+                        'replica_set': replica_set,
+                        'read_preference': read_preference,
+                        'max_staleness': max_staleness,
+                        'write_concern': write_concern,
+                        'collect_stats': collect_stats}
+        self._pid = None
+        self._pending = {}
+        self._pending_since = None
+        self._pending_lock = threading.RLock()
+        self._flusher = None
+        self._buffer_size = buffer_size
+        self._buffer_timeout = buffer_timeout
+        self._buffered = buffer_size is not None or buffer_timeout is not None
+        if cache_size is not None or cache_bytes is not None:
+            self._cache = LRUCache(cache_size, cache_bytes)
+        else:
+            self._cache = None
+        self._invalidator = None
+        self._stats = OperationStats() if collect_stats else None
+        self.round_trips = 0
+        if write_concern is None:
+            write_concern = {'w': 1 if safe else 0}
+        self._default_write_concern = _check_write_concern(write_concern)
+        self._write_concerns = [] # stack of `write_concern` blocks
         if index_type == 'key':
             self._index = INDEX_KEY
         elif index_type == 'key-value':
             self._index = INDEX_KEY_VALUE
         else:
             raise ValueError(u'Error: unknown `index_type`')
-        self._collection.ensure_index(self._index)
+        if compression is not None and compression not in COMPRESSORS:
+            raise ValueError(u'Error: unknown `compression`')
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._compression_stats = {'compressed': 0, 'decompressed': 0,
+                                   'bytes_in': 0, 'bytes_out': 0,
+                                   'compress_time': 0.0,
+                                   'decompress_time': 0.0}
+        self._chunk_threshold = chunk_threshold
+        self._chunk_size = chunk_size
+        self._approximate_len = approximate_len
+        self._len_cache_ttl = len_cache_ttl
+        self._cached_len = None
+        self._cached_len_time = None
+        self._cached_len_exact = False
+        self._ttl = ttl
+        _get_read_preference(read_preference) # validates it
+        self._read_preference = read_preference
+        self._max_staleness = max_staleness
+        self._lag = None
+        self._lag_time = None
+        self._connect()
+        if isinstance(codec, (text_type, binary_type)):
+            self._codec_name = codec
+            if codec != 'bson':
+                codec = _get_codec(codec)
+            else:
+                codec = CODECS['pickle']
+        else:
+            self._codec_name = None
+        self._encoder, self._decoder = codec
+        if self._codec_name is not None:
+            # documents without a codec name were written by dicts using the
+            # default codec
+            self._decoder = pickle.loads
+        # used to encode/decode binary values of documents without a codec
         self.encode_value = lambda value: Binary(codec[0](value))
         self.decode_value = lambda value: codec[1](binary_type(value))
         if default is not None:
             self.update(default)
 
+    def _connect(self):
+        config = self._config
+        if self._pid is not None:
+            # we are in a forked child: buffered writes belong to the parent
+            # and the parent's locks and threads are not usable here
+            self._pending.clear()
+            self._pending_since = None
+            self._pending_lock = threading.RLock()
+            self._flusher = None
+            self._invalidator = None
+            if self._cache is not None:
+                self._cache._lock = threading.Lock()
+            if self._stats is not None:
+                self._stats._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._client = get_client(host=config['host'], port=config['port'],
+                                  database=config['database'],
+                                  auth=config['auth'],
+                                  max_pool_size=config['max_pool_size'],
+                                  connect_timeout=config['connect_timeout'],
+                                  socket_timeout=config['socket_timeout'],
+                                  replica_set=config['replica_set'])
+        self._db = self._client[config['database']]
+        self._current_collection = self._db[config['collection']]
+        self._current_collection.write_concern = \
+                dict(self._default_write_concern)
+        _ensure_index(self._current_collection, self._index)
+
+    @property
+    def _connection(self):
+        if self._pid != os.getpid():
+            self._connect()
+        return self._client
+
+    @property
+    def _collection(self):
+        if self._pid != os.getpid():
+            self._connect()
+        return self._current_collection
+
+    @property
+    def _chunks(self):
+        collection = self._collection
+        return collection.database[collection.name + '.chunks']
+
+    def __getstate__(self):
+        return {'config': self._config}
+
+    def __setstate__(self, state):
+        self.__init__(**state['config'])
+
     def __setitem__(self, key, value):
         ''' Insert/update a key (uses upsert)
 
         ``key`` and ``value`` must be unicode or UTF-8.
         '''
-        value = self.encode_value(value)
-        return self._collection.update({'_id': key},
-                                       {'_id': key, 'v': value},
-                                       upsert=True)
+        if self._stats is not None:
+            return self._measure('__setitem__', self._set, key, value)
+        return self._set(key, value)
+
+    def set(self, key, value, ttl=_MISSING, write_concern=None):
+        ''' Insert/update a key (uses upsert)
+
+        If ``ttl`` (seconds) is provided, the key expires after ``ttl``
+        seconds: reads will not find it anymore and MongoDB will remove it
+        (using a TTL index). The default ``ttl`` is the one passed to the
+        constructor; use ``None`` for keys that never expire.
+        ``write_concern`` (a ``dict``, see ``__init__``) is used only by this
+        write, which is sent immediately even if writes are buffered.
+        '''
+        if self._stats is not None:
+            return self._measure('set', self._set, key, value, ttl,
+                                 write_concern)
+        return self._set(key, value, ttl, write_concern)
+
+    def _set(self, key, value, ttl=_MISSING, write_concern=None):
+        document = self._make_document(key, value, ttl)
+        if self._buffered and write_concern is None:
+            # reads must see buffered writes, so the cache is filled now
+            if self._cache is not None:
+                self._cache.put(key, value, _document_size(document),
+                                expires=document.get('e'))
+            return self._buffer(key, document)
+        if self._buffered:
+            with self._pending_lock: # waits for a running flush
+                self._pending.pop(key, None)
+        try:
+            result, version = self._upsert(key, document, write_concern)
+        except Exception:
+            # we don't know if the server has the old or the new value
+            if self._cache is not None:
+                self._cache.discard(key)
+            raise
+        if self._cache is not None:
+            self._cache.put(key, value, _document_size(document),
+                            expires=document.get('e'), version=version)
+        return result
+
+    def _upsert(self, key, document, write_concern=None):
+        ''' Write ``document`` (and its chunks)
+
+        Return the result and the new version (``None`` if unknown).
+        '''
+        options = self._write_options(write_concern)
+        document = self._store_chunks(key, document)
+        self.round_trips += 1
+        version = None
+        if self._is_default_write_concern(options):
+            # also returns the old chunk set, so we know if there are chunks
+            # to remove without an extra round trip
+            previous = self._collection.find_and_modify({'_id': key},
+                    _update_spec(document), upsert=True,
+                    fields={'k': 1, 'r': 1})
+            if previous and 'k' in previous:
+                self._remove_stale_chunks(key, document)
+            result = {'ok': 1.0, 'n': 1, 'updatedExisting': bool(previous)}
+            version = (previous or {}).get('r', 0) + 1
+        elif (options or self._default_write_concern).get('w') == 0:
+            # unacknowledged: we can't know if the old value had chunks (see
+            # `remove_orphan_chunks`)
+            result = self._collection.update({'_id': key},
+                                             _update_spec(document),
+                                             upsert=True, **options)
+        else:
+            try:
+                # a chunked document does not match, so its upsert fails
+                result = self._collection.update({'_id': key,
+                                                  'k': {'$exists': False}},
+                                                 _update_spec(document),
+                                                 upsert=True, **options)
+            except DuplicateKeyError: # the old value has chunks
+                self.round_trips += 1
+                result = self._collection.update({'_id': key},
+                                                 _update_spec(document),
+                                                 upsert=True, **options)
+                self._remove_stale_chunks(key, document, options)
+        if result is None: # unacknowledged
+            self._adjust_len(None)
+        elif not result.get('updatedExisting'):
+            self._adjust_len(1)
+        return result, version
+
+    def _is_default_write_concern(self, options):
+        ''' Return True if writes with ``options`` are just acknowledged
+
+        (``{'w': 1}``, so commands like ``findAndModify`` can be used)
+        '''
+        return (options or self._default_write_concern) == {'w': 1}
+
+    def _acknowledged_write_options(self, write_concern=None):
+        ''' Return the write options for a write whose result we need
+
+        Like ``_write_options``, but `w` is at least 1 (``{'w': 1}`` means
+        the default concern, so ``findAndModify`` can be used).
+        '''
+        options = self._write_options(write_concern) or \
+                  dict(self._default_write_concern)
+        if options.get('w') == 0:
+            options['w'] = 1
+        return options
+
+    def _write_options(self, write_concern=None):
+        ''' Return the write concern options for one write
+
+        ``None`` means the one of the current ``write_concern`` block (or the
+        collection's default, if there is no block).
+        '''
+        if write_concern is not None:
+            return _check_write_concern(write_concern)
+        if self._write_concerns:
+            return dict(self._write_concerns[-1])
+        return {}
+
+    @contextlib.contextmanager
+    def write_concern(self, **options):
+        ''' Use the write concern ``options`` inside a ``with`` block
+
+        For example, ``with my_dict.write_concern(w=0):`` sends unacknowledged
+        writes. Blocks can be nested and affect all threads using this
+        object. Buffered writes are flushed when the block exits, so they use
+        its write concern too.
+        '''
+        self._write_concerns.append(_check_write_concern(options))
+        try:
+            yield self
+            self.flush()
+        finally:
+            self._write_concerns.pop()
+
+    def _store_chunks(self, key, document):
+        ''' Store the value of ``document`` in chunks, if it's too big
+
+        Return the document that must be stored in the main collection (for
+        chunked values it points to the chunks instead of having a value).
+        Old chunks of ``key`` are kept: they must be removed (with
+        ``_remove_stale_chunks``) only after the main document points to the
+        new ones, so readers never see an incomplete value.
+        '''
+        if not isinstance(document['v'], binary_type) or \
+           len(document['v']) <= self._chunk_threshold:
+            return document
+        chunks = self._chunks
+        for index in CHUNK_INDEXES:
+            _ensure_index(chunks, index)
+        encoded = document['v']
+        chunk_set = ObjectId()
+        chunk_size = self._chunk_size
+        batch = []
+        for number, start in enumerate(range(0, len(encoded), chunk_size)):
+            batch.append({'f': key, 's': chunk_set, 'n': number,
+                          'd': Binary(encoded[start:start + chunk_size])})
+            if len(batch) == CHUNKS_PER_INSERT:
+                self.round_trips += 1
+                chunks.insert(batch)
+                batch = []
+        if batch:
+            self.round_trips += 1
+            chunks.insert(batch)
+        document = dict(document, k=chunk_set, l=len(encoded))
+        del document['v']
+        return document
+
+    def _remove_stale_chunks(self, key, document, options=None):
+        ''' Remove chunks of ``key`` not referenced by the stored ``document``
+
+        If ``document`` is not chunked, all chunks of ``key`` are removed.
+        '''
+        self.round_trips += 1
+        self._chunks.remove({'f': key, 's': {'$ne': document.get('k')}},
+                            **(options or {}))
+
+    def remove_orphan_chunks(self, min_age=3600):
+        ''' Remove chunks not referenced by any document
+
+        Unacknowledged writes (`w=0`) can't know if the value they replace
+        had chunks, so these are left behind. Only chunk sets older than
+        ``min_age`` seconds are checked, so values being written now are not
+        affected. Return how many chunk sets were removed.
+        '''
+        self.flush()
+        limit = datetime.datetime.utcnow() - \
+                datetime.timedelta(seconds=min_age)
+        self.round_trips += 1
+        chunk_sets = self._chunks.find({'s': {'$lt':
+                                        ObjectId.from_datetime(limit)}})\
+                                 .distinct('s')
+        referenced = set()
+        for batch in _split_keys(chunk_sets):
+            self.round_trips += 1
+            referenced.update(document['k'] for document in
+                              self._collection.find({'k': {'$in': batch}},
+                                                    {'k': 1, '_id': 0}))
+        orphans = [chunk_set for chunk_set in chunk_sets
+                   if chunk_set not in referenced]
+        for batch in _split_keys(orphans):
+            self.round_trips += 1
+            self._chunks.remove({'s': {'$in': batch}})
+        return len(orphans)
+
+    def _iter_chunks(self, document):
+        ''' Iterate over the stored (maybe compressed) pieces of a value '''
+        if 'k' not in document:
+            yield binary_type(document['v'])
+            return
+        self.round_trips += 1
+        cursor = self._chunks.find({'s': document['k']}, {'d': 1})\
+                             .sort('n', 1)\
+                             .batch_size(16) # bounded memory usage
+        for chunk in cursor:
+            yield binary_type(chunk['d'])
+
+    def _make_document(self, key, value, ttl=_MISSING):
+        if self._stats is None:
+            return self._encode_document(key, value, ttl)
+        start_time = time.time()
+        document = self._encode_document(key, value, ttl)
+        self._stats.add(encoded=1, encode_time=time.time() - start_time,
+                        bytes_sent=_key_size(key) + _document_size(document))
+        return document
+
+    def _encode_document(self, key, value, ttl=_MISSING):
+        document = {'_id': key}
+        if ttl is _MISSING:
+            ttl = self._ttl
+        if ttl is not None:
+            _ensure_index(self._collection, TTL_INDEX, sparse=True,
+                          expireAfterSeconds=0)
+            document['e'] = datetime.datetime.utcnow() + \
+                            datetime.timedelta(seconds=ttl)
+        codec_name = self._codec_name
+        if codec_name == 'bson':
+            if _is_bson_native(value):
+                document['v'] = value
+                document['c'] = codec_name
+                return document
+            codec_name = 'pickle'
+        if codec_name is None:
+            encoded = self._encoder(value)
+        else:
+            encoded = _get_codec(codec_name)[0](value)
+            document['c'] = codec_name
+        if self._compression is not None and \
+           len(encoded) >= self._compression_threshold:
+            compressed = self._compress(encoded)
+            if len(compressed) < len(encoded):
+                document['z'] = self._compression
+                encoded = compressed
+        document['v'] = Binary(encoded)
+        return document
+
+    def _compress(self, data):
+        stats = self._compression_stats
+        start_time = process_time()
+        compressed = COMPRESSORS[self._compression][0](data)
+        stats['compress_time'] += process_time() - start_time
+        stats['compressed'] += 1
+        stats['bytes_in'] += len(data)
+        stats['bytes_out'] += len(compressed)
+        return compressed
+
+    def _decompress(self, algorithm, data):
+        decompress = _get_compressor(algorithm)[1]
+        start_time = process_time()
+        data = decompress(data)
+        stats = self._compression_stats
+        stats['decompress_time'] += process_time() - start_time
+        stats['decompressed'] += 1
+        return data
+
+    def _decode_document(self, document):
+        if self._stats is None:
+            return self._decode_value(document)
+        start_time = time.time()
+        value = self._decode_value(document)
+        self._stats.add(decoded=1, decode_time=time.time() - start_time,
+                        bytes_received=_document_size(document))
+        return value
+
+    def _decode_value(self, document):
+        codec_name = document.get('c')
+        if codec_name == 'bson':
+            return document['v']
+        if 'k' in document:
+            encoded = bytearray()
+            for piece in self._iter_chunks(document):
+                encoded.extend(piece)
+            if len(encoded) != document['l']:
+                raise ValueError(u'Error: chunks of value changed while '
+                                 u'reading')
+            encoded = binary_type(encoded)
+        else:
+            encoded = binary_type(document['v'])
+        if 'z' in document:
+            encoded = self._decompress(document['z'], encoded)
+        if codec_name is None:
+            return self._decoder(encoded)
+        return _get_codec(codec_name)[1](encoded)
+
+    def open_value(self, key):
+        ''' Return a read-only file-like object with the value of ``key``
+
+        The object streams the *encoded* value (decompressed, if needed), so
+        big chunked values can be read without loading them in memory. It is
+        specially useful with the `raw` codec (the encoded value is the value)
+        and with `pickle` (use ``pickle.load``).
+        If not found, raises ``KeyError``.
+        '''
+        document = self._get_pending(key)
+        if document is _MISSING:
+            document = self._find_one({'_id': key}, dict(VALUE_FIELDS, _id=0))
+        if document is None:
+            raise KeyError(key)
+        if document.get('c') == 'bson':
+            raise TypeError(u'Error: value is stored natively, not encoded')
+        pieces = self._iter_chunks(document)
+        if 'z' in document:
+            pieces = _decompress_pieces(pieces, document['z'])
+        return io.BufferedReader(ValueReader(pieces))
+
+    def compression_info(self):
+        ''' Return compression counters
+
+        The returned ``dict`` has the keys ``compressed`` and
+        ``decompressed`` (number of values), ``bytes_in`` and ``bytes_out``
+        (sizes before and after compression), ``ratio`` (``bytes_in`` /
+        ``bytes_out``), ``compress_time`` and ``decompress_time`` (CPU
+        seconds of the process, so other threads running at the same time
+        are also counted).
+        '''
+        info = dict(self._compression_stats)
+        if info['bytes_out']:
+            info['ratio'] = info['bytes_in'] / float(info['bytes_out'])
+        else:
+            info['ratio'] = None
+        return info
 
     def __getitem__(self, key):
         ''' Return the value for key ``key``
@@ -88,44 +1381,1125 @@ class MongoDict(MutableMapping):
         ``key`` must be unicode or UTF-8.
         If not found, raises ``KeyError``.
         '''
-        result = self._collection.find({'_id': key},
-                                       {'v': 1, '_id': 0})\
-                                 .hint(self._index)
-        if result.count() == 0:
+        if self._stats is not None:
+            return self._measure('__getitem__', self._get, key)
+        return self._get(key)
+
+    def get(self, key, default=None, read_from=None):
+        ''' Return the value for ``key`` or ``default`` if not found
+
+        ``read_from`` overrides `read_preference` for this lookup (for
+        example, ``'secondary'``).
+        '''
+        try:
+            if self._stats is not None:
+                return self._measure('get', self._get, key, read_from)
+            return self._get(key, read_from)
+        except KeyError: # measured as an error, as in ``__getitem__``
+            return default
+
+    def _get(self, key, read_from=None):
+        document = self._get_pending(key)
+        if document is None:
+            raise KeyError(key)
+        elif document is not _MISSING:
+            return self._decode_document(document)
+        generation = None
+        if self._cache is not None:
+            value = self._cache.get(key)
+            if value is not _MISSING:
+                return value
+            generation = self._cache.generation
+        document = self._find_one({'_id': key}, dict(VALUE_FIELDS, _id=0),
+                                   read_from)
+        if document is None:
             raise KeyError(key)
-        return self.decode_value(result[0]['v'])
+        return self._decode_and_cache(key, document, generation)
+
+    def _find_one(self, spec, fields, read_from=None):
+        ''' Return the first document matching ``spec`` in one round trip
+
+        Expired documents are not returned.
+        '''
+        options = self._read_options(read_from)
+        self.round_trips += 1
+        cursor = self._collection.find(spec, fields, **options)\
+                                 .hint(self._index)\
+                                 .limit(-1) # single batch, closes the cursor
+        for document in cursor:
+            if not _is_expired(document):
+                return document
+        return None
+
+    def _read_options(self, read_from=None):
+        ''' Return the ``find`` options to read using ``read_from``
+
+        ``None`` means the `read_preference` of this object. Secondaries are
+        not used while they lag more than `max_staleness`.
+        '''
+        name = read_from if read_from is not None else self._read_preference
+        if name == 'primary':
+            return {}
+        if self._max_staleness is not None and name != 'primary_preferred':
+            now = time.time()
+            if self._lag_time is None or \
+               now - self._lag_time >= STALENESS_CHECK_INTERVAL:
+                self.round_trips += 1
+                try:
+                    self._lag = _replication_lag(self._connection)
+                except PyMongoError: # we can't know: play safe
+                    self._lag = float('inf')
+                self._lag_time = now
+            if self._lag is not None and self._lag > self._max_staleness:
+                return {'read_preference': pymongo.ReadPreference.PRIMARY}
+        return {'read_preference': _get_read_preference(name)}
+
+    def _get_pending(self, key):
+        ''' Return the buffered document for ``key``
+
+        Return ``_MISSING`` if there is no buffered write for ``key`` and
+        ``None`` if it was deleted (or expired).
+        '''
+        document = self._pending.get(key, _MISSING)
+        if document is _DELETED or \
+           (document is not _MISSING and _is_expired(document)):
+            return None
+        return document
+
+    def _decode_and_cache(self, key, document, generation=None):
+        value = self._decode_document(document)
+        if self._cache is not None:
+            self._cache.put(key, value, _document_size(document),
+                            generation, document.get('e'),
+                            document.get('r', 0))
+        return value
 
     def __delitem__(self, key):
         ''' Delete the key/value for key ``key``
 
         ``key`` must be unicode or UTF-8.
-        If not found, raises ``KeyError``.
+        If not found, raises ``KeyError`` (so the write is always
+        acknowledged: `w` is at least 1).
         '''
-        if key not in self:
+        if self._stats is not None:
+            return self._measure('__delitem__', self._delete, key)
+        return self._delete(key)
+
+    def _delete(self, key):
+        if self._cache is not None:
+            self._cache.discard(key)
+        if self._buffered:
+            if key not in self:
+                raise KeyError(key)
+            return self._buffer(key, _DELETED)
+        # acknowledged, so we know if the key existed
+        options = self._acknowledged_write_options()
+        if not self._is_default_write_concern(options):
+            # `find_and_modify` ignores `w`, `j` and `wtimeout`, so plain
+            # removes are used: first of a document without chunks (the
+            # common case) and then, if there was none, of a chunked one.
+            # Expired documents are left to the TTL index.
+            spec = _not_expired_spec(key, datetime.datetime.utcnow())
+            self.round_trips += 1
+            result = self._collection.remove(dict(spec,
+                                                  k={'$exists': False}),
+                                             **options)
+            if result['n'] == 0:
+                self.round_trips += 1
+                result = self._collection.remove(dict(spec,
+                                                      k={'$exists': True}),
+                                                 **options)
+                if result['n'] == 0:
+                    raise KeyError(key)
+                self.round_trips += 1
+                self._chunks.remove({'f': key}, **options)
+            self._adjust_len(-1)
+            return
+        # `find_and_modify` tells if the key existed, if it expired and if it
+        # had chunks in only one round trip
+        self.round_trips += 1
+        document = self._collection.find_and_modify({'_id': key},
+                                                    remove=True,
+                                                    fields={'k': 1, 'e': 1})
+        if document is None:
+            raise KeyError(key)
+        self._adjust_len(-1)
+        if 'k' in document:
+            self.round_trips += 1
+            self._chunks.remove({'f': key})
+        if _is_expired(document):
             raise KeyError(key)
-        return self._collection.remove({'_id': key})
 
     def clear(self):
         ''' Delete all key/value pairs '''
-        self._collection.remove({}, safe=self._safe)
+        with self._pending_lock:
+            self._pending.clear()
+            self._pending_since = None
+        if self._cache is not None:
+            self._cache.clear()
+        options = self._write_options()
+        self.round_trips += 2
+        result = self._collection.remove({}, **options)
+        self._chunks.remove({}, **options)
+        if self._cached_len is not None:
+            self._cached_len = 0 if result is not None else None
+            self._cached_len_exact = True
 
     def __len__(self):
-        ''' Return how many key/value pairs are stored '''
-        return self._collection.count()
+        ''' Return how many key/value pairs are stored
+
+        See `approximate_len` and `len_cache_ttl` parameters and ``count``
+        (expired keys are counted until they are removed).
+        '''
+        if self._stats is not None:
+            return self._measure('__len__', self.count, self._approximate_len)
+        return self.count(approximate=self._approximate_len)
+
+    def count(self, approximate=False):
+        ''' Return how many key/value pairs are stored
+
+        If ``approximate``, use the collection metadata instead of counting.
+        The length cached by `len_cache_ttl` is used only if it is exact or
+        an approximate count was asked for.
+        Expired keys are counted until MongoDB removes them (the TTL monitor
+        runs about once a minute).
+        '''
+        self.flush()
+        if self._cached_len is not None and \
+           (self._cached_len_exact or approximate) and \
+           time.time() - self._cached_len_time <= self._len_cache_ttl:
+            return self._cached_len
+        self.round_trips += 1
+        if approximate:
+            collection = self._collection
+            stats = collection.database.command('collstats', collection.name)
+            length = int(stats.get('count', 0))
+        else:
+            length = self._collection.count()
+        if self._len_cache_ttl is not None:
+            self._cached_len = length
+            self._cached_len_time = time.time()
+            self._cached_len_exact = not approximate
+        return length
+
+    def _adjust_len(self, delta):
+        ''' Keep the cached length updated (``None`` means unknown) '''
+        if self._cached_len is not None:
+            if delta is None:
+                self._cached_len = None
+            else:
+                self._cached_len += delta
 
     def __iter__(self):
         ''' Iterate over all stored keys '''
-        return (pair['_id']
-                for pair in self._collection.find({}, {'_id': 1}))
+        if self._stats is not None:
+            return self._measure_iteration('__iter__', self.iterkeys())
+        return self.iterkeys()
+
+    def iterkeys(self, batch_size=ITER_BATCH_SIZE):
+        ''' Iterate over all stored keys, ``batch_size`` keys per batch '''
+        self.flush()
+        self.round_trips += 1
+        cursor = self._collection.find({}, KEY_FIELDS, **self._read_options())\
+                                 .batch_size(batch_size)
+        return (document['_id'] for document in _not_expired(cursor))
+
+    def iteritems(self, batch_size=ITER_BATCH_SIZE):
+        ''' Iterate over all stored (key, value) pairs
+
+        Keys and values come from only one cursor (``batch_size`` documents
+        per batch) and values are decoded as the pairs are consumed.
+        '''
+        self.flush()
+        self.round_trips += 1
+        cursor = self._collection.find({}, VALUE_FIELDS,
+                                       **self._read_options())\
+                                 .batch_size(batch_size)
+        return ((document['_id'], self._decode_document(document))
+                for document in _not_expired(cursor))
+
+    def itervalues(self, batch_size=ITER_BATCH_SIZE):
+        ''' Iterate over all stored values (see ``iteritems``) '''
+        return (value for key, value in self.iteritems(batch_size))
+
+    def incr(self, key, delta=1):
+        ''' Atomically add ``delta`` to the counter ``key`` and return it
+
+        Counters are stored as native BSON numbers (as with the `bson` codec)
+        and updated with an ``$inc`` upsert, so concurrent increments are not
+        lost and a missing key is treated as 0. Read counters as usual (as
+        ``my_dict[key]``). Raises ``pymongo.errors.OperationFailure`` if the
+        stored value is not a number.
+        The write is always acknowledged (`w` is at least 1). If the write
+        concern has `j`, `wtimeout` or `w` > 1, the ``$inc`` is sent as an
+        update using it and the value is read back from the primary (one
+        more round trip), so it may include concurrent increments. An
+        expired key (not removed yet) starts again from 0.
+        '''
+        if key in self._pending:
+            self.flush()
+        # acknowledged, so we know if the key was created
+        options = self._acknowledged_write_options()
+        now = datetime.datetime.utcnow()
+        try:
+            value, updated_existing, version = self._increment(key, delta,
+                                                               now, options)
+        except DuplicateKeyError: # the key expired, but was not removed yet
+            self._reset_expired_counters([key], now, options)
+            value, updated_existing, version = self._increment(key, delta,
+                                                               now, options)
+        if not updated_existing:
+            self._adjust_len(1)
+        if self._cache is not None:
+            self._cache.put(key, value, _value_size(value), version=version)
+        return value
+
+    def _increment(self, key, delta, now, options):
+        ''' ``$inc`` the counter ``key`` if it did not expire
+
+        Return (new value, True if the key existed, new version). An expired
+        key makes the upsert raise ``DuplicateKeyError``.
+        '''
+        spec = _not_expired_spec(key, now)
+        update = _increment_spec(delta)
+        self.round_trips += 1
+        if self._is_default_write_concern(options):
+            response = self._collection.find_and_modify(spec, update,
+                    upsert=True, new=True, fields={'v': 1, 'r': 1},
+                    full_response=True)
+            return (response['value']['v'],
+                    response['lastErrorObject'].get('updatedExisting'),
+                    response['value']['r'])
+        # `find_and_modify` ignores `w`, `j` and `wtimeout`
+        result = self._collection.update(spec, update, upsert=True,
+                                         **options)
+        document = self._find_one({'_id': key}, {'v': 1, 'r': 1}, 'primary')
+        return document['v'], result.get('updatedExisting'), document['r']
+
+    def _reset_expired_counters(self, keys, now, options):
+        ''' Store 0 (and no expiration) in the expired documents of ``keys``
+
+        So they can be incremented again (their chunks are also removed).
+        '''
+        self.round_trips += 2
+        self._collection.update({'_id': {'$in': keys}, 'e': {'$lte': now}},
+                {'$set': {'v': 0, 'c': 'bson'},
+                 '$unset': {'e': '', 'k': '', 'l': '', 'z': ''}},
+                multi=True, **options)
+        self._chunks.remove({'f': {'$in': keys}}, **options)
+
+    def decr(self, key, delta=1):
+        ''' Atomically subtract ``delta`` from the counter ``key`` '''
+        return self.incr(key, -delta)
+
+    def incr_many(self, deltas, batch_size=BULK_BATCH_SIZE):
+        ''' Atomically increment many counters using bulk ``$inc`` upserts
+
+        ``deltas`` can be a mapping or an iterable of (key, delta). Return the
+        list of per-batch results (new values are not returned). As with
+        ``incr``, writes are always acknowledged and expired keys (not
+        removed yet) start again from 0.
+        '''
+        self.flush()
+        options = self._acknowledged_write_options()
+        results = []
+        increments = []
+        for key, delta in _iter_pairs(deltas):
+            if self._cache is not None:
+                self._cache.discard(key)
+            increments.append((key, delta))
+            if len(increments) >= batch_size:
+                results.append(self._execute_increments(increments, options))
+                increments = []
+        if increments:
+            results.append(self._execute_increments(increments, options))
+        return results
+
+    def _execute_increments(self, increments, options):
+        ''' ``$inc`` the (key, delta) ``increments`` in one bulk write
+
+        The upserts of expired keys (not removed yet) fail with duplicate key
+        errors: these counters are reset and incremented again.
+        '''
+        now = datetime.datetime.utcnow()
+        bulk = self._collection.initialize_unordered_bulk_op()
+        for key, delta in increments:
+            bulk.find(_not_expired_spec(key, now)).upsert()\
+                .update_one(_increment_spec(delta))
+        self.round_trips += 1
+        try:
+            result = bulk.execute(options)
+        except BulkWriteError as error:
+            result = error.details
+            expired = [increments[write_error['index']]
+                       for write_error in result['writeErrors']
+                       if write_error['code'] in DUPLICATE_KEY_ERRORS]
+            if len(expired) != len(result['writeErrors']):
+                raise
+            self._adjust_len(result['nUpserted'])
+            self._reset_expired_counters([key for key, delta in expired], now,
+                                         options)
+            retried = self._execute_increments(expired, options)
+            for field in ('nMatched', 'nModified', 'nUpserted'):
+                result[field] = result.get(field, 0) + retried.get(field, 0)
+            result['writeErrors'] = []
+            return result
+        self._adjust_len(result['nUpserted'])
+        return result
+
+    def get_with_version(self, key):
+        ''' Return (value, version) for ``key``
+
+        Each write increments the version of the key (documents written by
+        old versions of mongodict have version 0). Always reads from the
+        primary (the cache is not used). If not found, raises ``KeyError``.
+        '''
+        self.flush()
+        document = self._find_one({'_id': key},
+                                  dict(VALUE_FIELDS, _id=0), 'primary')
+        if document is None:
+            raise KeyError(key)
+        return self._decode_document(document), document.get('r', 0)
+
+    def compare_and_set(self, key, value, expected_version, ttl=_MISSING,
+                        write_concern=None):
+        ''' Set ``key`` only if its version is still ``expected_version``
+
+        Use the version returned by ``get_with_version`` (or 0 to create a
+        key that must not exist). It's only one conditional update, so it's
+        atomic. Return True if the value was stored, False otherwise.
+        The write is always acknowledged (`w` is at least 1).
+        '''
+        self.flush()
+        document = self._make_document(key, value, ttl)
+        if expected_version == 0:
+            # missing key, document without version or expired document
+            spec = {'_id': key, '$or': [{'r': None}, {'r': 0},
+                    {'e': {'$lte': datetime.datetime.utcnow()}}]}
+        else:
+            spec = {'_id': key, 'r': expected_version}
+        document = self._store_chunks(key, document)
+        self.round_trips += 1
+        # acknowledged, so we know if the version matched
+        options = self._acknowledged_write_options(write_concern)
+        try:
+            result = self._collection.update(spec, _update_spec(document),
+                                             upsert=expected_version == 0,
+                                             **options)
+        except DuplicateKeyError: # upsert of a key that already exists
+            stored = False
+        else:
+            stored = result['n'] == 1
+            if stored and not result.get('updatedExisting'):
+                self._adjust_len(1)
+        if stored:
+            self._remove_stale_chunks(key, document, options)
+        elif 'k' in document: # the new chunks will never be referenced
+            self.round_trips += 1
+            self._chunks.remove({'s': document['k']})
+        if self._cache is not None:
+            if stored:
+                self._cache.put(key, value, _document_size(document),
+                                expires=document.get('e'),
+                                version=expected_version + 1
+                                        if expected_version else None)
+            else:
+                self._cache.discard(key)
+        return stored
+
+    def update_with(self, key, function, retries=10, default=_MISSING):
+        ''' Atomically replace the value of ``key`` by ``function(value)``
+
+        Read-modify-write using ``get_with_version`` and ``compare_and_set``,
+        retrying up to ``retries`` times if other writers change ``key`` in
+        the meantime (``function`` may be called more than once). If ``key``
+        is not found, ``function`` receives ``default`` (or ``KeyError`` is
+        raised if it's not provided). Return the new value or raises
+        ``VersionConflict`` if all retries fail.
+        '''
+        for attempt in range(retries + 1):
+            try:
+                value, version = self.get_with_version(key)
+            except KeyError:
+                if default is _MISSING:
+                    raise
+                value, version = default, 0
+            new_value = function(value)
+            if self.compare_and_set(key, new_value, version):
+                return new_value
+        raise VersionConflict(key)
+
+    def iter_range(self, start=None, stop=None, reverse=False, limit=None,
+                   batch_size=ITER_BATCH_SIZE, keys_only=False):
+        ''' Iterate over (key, value) pairs with ``start <= key < stop``
+
+        The pairs are sorted by key (descending if ``reverse``) and are read
+        from one cursor bounded by the `_id` index. ``None`` means no bound.
+        If ``keys_only``, only keys are returned (values are not read).
+        '''
+        key_range = {}
+        if start is not None:
+            key_range['$gte'] = start
+        if stop is not None:
+            key_range['$lt'] = stop
+        return self._iter_key_range(key_range, reverse, limit, batch_size,
+                                    keys_only)
+
+    def iter_prefix(self, prefix, reverse=False, limit=None,
+                    batch_size=ITER_BATCH_SIZE, keys_only=False):
+        ''' Iterate over (key, value) pairs whose keys start with ``prefix``
+
+        See ``iter_range``.
+        '''
+        return self._iter_key_range(_prefix_range(prefix), reverse, limit,
+                                    batch_size, keys_only)
+
+    def _iter_key_range(self, key_range, reverse, limit, batch_size,
+                        keys_only):
+        self.flush()
+        spec = {'_id': key_range} if key_range else {}
+        fields = KEY_FIELDS if keys_only else VALUE_FIELDS
+        self.round_trips += 1
+        cursor = self._collection.find(spec, fields, **self._read_options())\
+                                 .sort('_id', -1 if reverse else 1)\
+                                 .batch_size(batch_size)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        if keys_only:
+            return (document['_id'] for document in _not_expired(cursor))
+        return ((document['_id'], self._decode_document(document))
+                for document in _not_expired(cursor))
+
+    def delete_prefix(self, prefix):
+        ''' Delete all pairs whose keys start with ``prefix``
+
+        Return how many pairs were deleted (``None`` if unacknowledged).
+        '''
+        self.flush()
+        key_range = _prefix_range(prefix)
+        if self._cache is not None:
+            self._cache.discard_matching(lambda key:
+                    _in_key_range(key, key_range))
+        options = self._write_options()
+        self.round_trips += 2
+        result = self._collection.remove({'_id': key_range}, **options)
+        self._chunks.remove({'f': key_range}, **options)
+        if result is None:
+            self._adjust_len(None)
+        else:
+            self._adjust_len(-result['n'])
+            return result['n']
+
+    if sys.version_info[0] == 2:
+        def items(self, batch_size=ITER_BATCH_SIZE):
+            ''' Return a list with all stored (key, value) pairs '''
+            return list(self.iteritems(batch_size))
+
+        def values(self, batch_size=ITER_BATCH_SIZE):
+            ''' Return a list with all stored values '''
+            return list(self.itervalues(batch_size))
+    else:
+        def items(self, batch_size=ITER_BATCH_SIZE):
+            ''' Return a view of all stored (key, value) pairs '''
+            return StreamingItemsView(self, batch_size)
+
+        def values(self, batch_size=ITER_BATCH_SIZE):
+            ''' Return a view of all stored values '''
+            return StreamingValuesView(self, batch_size)
 
     def __contains__(self, key):
         ''' Return True/False if a key is/is not stored in the collection '''
-        results = self._collection.find({'_id': key}, {'_id': 1})
-        return results.count() > 0
+        if self._stats is not None:
+            return self._measure('__contains__', self._contains, key)
+        return self._contains(key)
 
     has_key = __contains__
 
+    def _contains(self, key):
+        document = self._get_pending(key)
+        if document is not _MISSING:
+            return document is not None
+        if self._cache is not None and key in self._cache:
+            return True
+        return self._find_one({'_id': key}, KEY_FIELDS) is not None
+
+    def _buffer(self, key, document):
+        if self._pid != os.getpid():
+            self._connect() # buffered writes of the parent are not ours
+        with self._pending_lock:
+            if not self._pending:
+                self._pending_since = time.time()
+            self._pending[key] = document
+            if self._buffer_timeout is not None and self._flusher is None:
+                self._flusher = BufferFlusher(self, self._buffer_timeout)
+                self._flusher.start()
+            if (self._buffer_size is not None and
+                    len(self._pending) >= self._buffer_size) or \
+               (self._buffer_timeout is not None and
+                    time.time() - self._pending_since >=
+                    self._buffer_timeout):
+                self.flush()
+
+    def _flush_old_writes(self):
+        ''' Flush if the oldest buffered write reached `buffer_timeout`
+
+        Called by the ``BufferFlusher`` thread. Return how many seconds to
+        wait before checking again.
+        '''
+        with self._pending_lock:
+            if self._pending_since is None:
+                return self._buffer_timeout
+            age = time.time() - self._pending_since
+            if age < self._buffer_timeout:
+                return self._buffer_timeout - age
+            try:
+                self.flush()
+            except PyMongoError:
+                pass # the writes are kept: the next flush raises, if needed
+            return self._buffer_timeout
+
+    def flush(self):
+        ''' Send all buffered writes to MongoDB in one bulk write
+
+        Repeated writes to the same key are merged, so only the last one is
+        sent. Return the bulk write result (``None`` if nothing was pending).
+        If the bulk write fails, the writes are kept in the buffer (so the
+        next flush sends them again).
+        '''
+        with self._pending_lock:
+            if not self._pending:
+                return None
+            operations = list(self._pending.items())
+            result = self._bulk_write(operations)
+            self._pending.clear()
+            self._pending_since = None
+            return result
+
+    def update(self, other=(), **kwargs):
+        ''' Update the dict with pairs from ``other`` and ``kwargs``
+
+        Accepts the same arguments as ``dict.update`` but sends the pairs
+        using unordered bulk upserts (see ``set_many``). Return the list of
+        per-batch results.
+        '''
+        if self._stats is not None:
+            return self._measure('update', self._set_many,
+                                 _iter_pairs(other, kwargs))
+        return self._set_many(_iter_pairs(other, kwargs))
+
+    def set_many(self, pairs, batch_size=BULK_BATCH_SIZE, ttl=_MISSING,
+                 write_concern=None):
+        ''' Insert/update lots of pairs using unordered bulk upserts
+
+        ``pairs`` can be a mapping or an iterable of (key, value). Pairs are
+        sent in batches of ``batch_size`` upserts; if a key is repeated, the
+        last value wins. ``ttl`` and ``write_concern`` work as in ``set``.
+        Return the list of per-batch results.
+        '''
+        if self._stats is not None:
+            return self._measure('set_many', self._set_many, pairs,
+                                 batch_size, ttl, write_concern)
+        return self._set_many(pairs, batch_size, ttl, write_concern)
+
+    def _set_many(self, pairs, batch_size=BULK_BATCH_SIZE, ttl=_MISSING,
+                  write_concern=None):
+        self.flush()
+        results = []
+        batch = {}
+        for key, value in _iter_pairs(pairs):
+            batch[key] = value
+            if len(batch) >= batch_size:
+                results.append(self._bulk_upsert(batch, ttl, write_concern))
+                batch = {}
+        if batch:
+            results.append(self._bulk_upsert(batch, ttl, write_concern))
+        return results
+
+    def _bulk_upsert(self, pairs, ttl=_MISSING, write_concern=None):
+        operations = [(key, self._make_document(key, value, ttl))
+                      for key, value in pairs.items()]
+        try:
+            result = self._bulk_write(operations, write_concern)
+        except Exception:
+            # some of the writes may have been applied
+            if self._cache is not None:
+                for key, document in operations:
+                    self._cache.discard(key)
+            raise
+        if self._cache is not None:
+            for key, document in operations:
+                self._cache.put(key, pairs[key], _document_size(document),
+                                expires=document.get('e'))
+        return result
+
+    def _bulk_write(self, operations, write_concern=None):
+        ''' Execute (key, document) upserts as an unordered bulk write
+
+        ``_DELETED`` as document means the key must be removed.
+        '''
+        bulk = self._collection.initialize_unordered_bulk_op()
+        chunk_sets = []
+        for key, document in operations:
+            if document is _DELETED:
+                bulk.find({'_id': key}).remove_one()
+            else:
+                document = self._store_chunks(key, document)
+                if 'k' in document:
+                    chunk_sets.append(document['k'])
+                bulk.find({'_id': key}).upsert()\
+                    .update_one(_update_spec(document))
+        options = self._write_options(write_concern)
+        self.round_trips += 1
+        result = bulk.execute(options or None)
+        if result is None:
+            self._adjust_len(None)
+        else:
+            self._adjust_len(result['nUpserted'] - result['nRemoved'])
+        # we don't know which old values were chunked, so remove all chunks
+        # of these keys but the new ones
+        for keys in _split_keys(key for key, document in operations):
+            self.round_trips += 1
+            self._chunks.remove({'f': {'$in': keys},
+                                 's': {'$nin': chunk_sets}}, **options)
+        return result
+
+    def get_many(self, keys, default=_MISSING, read_from=None):
+        ''' Return a ``dict`` with the values for all ``keys``
+
+        Keys are fetched using ``$in`` queries (split in batches so no query
+        exceeds BSON limits) instead of one query per key. Keys not found are
+        left out of the result unless ``default`` is provided, in which case
+        they are filled with it. ``read_from`` works as in ``get``.
+        '''
+        if self._stats is not None:
+            return self._measure('get_many', self._get_many, keys, default,
+                                 read_from)
+        return self._get_many(keys, default, read_from)
+
+    def _get_many(self, keys, default=_MISSING, read_from=None):
+        keys = list(keys)
+        result = {}
+        to_fetch = set()
+        for key in keys:
+            document = self._get_pending(key)
+            if document is not _MISSING:
+                if document is not None:
+                    result[key] = self._decode_document(document)
+                continue
+            if self._cache is not None:
+                value = self._cache.get(key)
+                if value is not _MISSING:
+                    result[key] = value
+                    continue
+            to_fetch.add(key)
+        generation = None
+        if self._cache is not None:
+            generation = self._cache.generation
+        options = self._read_options(read_from) if to_fetch else {}
+        for batch in _split_keys(to_fetch):
+            self.round_trips += 1
+            documents = self._collection.find({'_id': {'$in': batch}},
+                                              VALUE_FIELDS, **options)\
+                                        .hint(self._index)
+            for document in _not_expired(documents):
+                key = document['_id']
+                result[key] = self._decode_and_cache(key, document,
+                                                     generation)
+        if default is not _MISSING:
+            for key in keys:
+                if key not in result:
+                    result[key] = default
+        return result
+
+    def contains_many(self, keys, read_from=None):
+        ''' Return a ``set`` with the ``keys`` that are stored
+
+        ``read_from`` works as in ``get``.
+        '''
+        present = set()
+        to_check = set()
+        for key in keys:
+            document = self._get_pending(key)
+            if document is not _MISSING:
+                if document is not None:
+                    present.add(key)
+            elif self._cache is not None and key in self._cache:
+                present.add(key)
+            else:
+                to_check.add(key)
+        options = self._read_options(read_from) if to_check else {}
+        for batch in _split_keys(to_check):
+            self.round_trips += 1
+            documents = self._collection.find({'_id': {'$in': batch}},
+                                              KEY_FIELDS, **options)
+            present.update(document['_id']
+                           for document in _not_expired(documents))
+        return present
+
+    def cache_info(self):
+        ''' Return cache counters (``None`` if cache is disabled)
+
+        The returned ``dict`` has the keys ``hits``, ``misses``,
+        ``evictions``, ``entries`` and ``bytes``.
+        '''
+        if self._cache is None:
+            return None
+        return self._cache.info()
+
+    def stats(self):
+        ''' Return operation counters (``None`` if `collect_stats` is False)
+
+        The returned ``dict`` has ``operations`` (for each measured mapping
+        operation, ``get``, ``set``, ``get_many``, ``set_many`` and
+        ``update``: ``calls``, ``errors`` -- like ``KeyError`` --, ``time``
+        and ``max_time`` in seconds and a latency ``histogram``: how many
+        calls took at most each of the ``buckets`` seconds, plus one more
+        for slower calls), how many values were ``encoded``/``decoded``, the
+        time spent doing it (``encode_time``/``decode_time``, including
+        compression and chunk reads) and the encoded size of values written
+        and read (``bytes_sent``/``bytes_received``).
+        '''
+        if self._stats is None:
+            return None
+        return self._stats.info()
+
+    def reset_stats(self):
+        ''' Zero all counters returned by ``stats`` '''
+        if self._stats is not None:
+            self._stats.reset()
+
+    def _measure(self, operation, function, *args):
+        start_time = time.time()
+        try:
+            result = function(*args)
+        except Exception:
+            self._stats.record(operation, time.time() - start_time, True)
+            raise
+        self._stats.record(operation, time.time() - start_time)
+        return result
+
+    def _measure_iteration(self, operation, iterator):
+        ''' Yield from ``iterator`` measuring only the time spent in it '''
+        elapsed, error = 0.0, False
+        try:
+            while True:
+                start_time = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                except Exception:
+                    error = True
+                    raise
+                finally:
+                    elapsed += time.time() - start_time
+                yield item
+        finally:
+            self._stats.record(operation, elapsed, error)
+
+    def watch_changes(self, retry_interval=1):
+        ''' Invalidate cached keys when other processes change them
+
+        Starts a ``CacheInvalidator`` thread, which tails the oplog (needs a
+        replica set). Return the invalidator.
+        '''
+        if self._cache is None:
+            raise ValueError(u'Error: cache is disabled')
+        if self._invalidator is None:
+            self._invalidator = CacheInvalidator(self._cache,
+                                                 self._collection,
+                                                 retry_interval)
+            self._invalidator.start()
+        return self._invalidator
+
+    def stop_watching_changes(self):
+        ''' Stop the thread started by ``watch_changes`` '''
+        if self._invalidator is not None:
+            self._invalidator.stop()
+            self._invalidator = None
+
     def __del__(self):
-        ''' Sync all operations and disconnect '''
-        self._connection.fsync()
-        self._connection.disconnect()
+        ''' Send buffered writes and stop watching changes (and flushing)
+
+        The server is not asked to ``fsync`` (it is expensive; durability is
+        set by the write concern) and the connection pool is shared, so it
+        is not disconnected (see ``close_clients``).
+        '''
+        if self._pid != os.getpid():
+            return # nothing was done in this (forked) process
+        if self._flusher is not None:
+            self._flusher.stop()
+        self.stop_watching_changes()
+        self.flush()
+
+
+class ShardedMongoDict(MutableMapping):
+    ''' ``dict``-like interface spreading keys over many ``MongoDict`` '''
+
+    def __init__(self, shards, replicas=SHARD_REPLICAS, **kwargs):
+        ''' Spread keys over ``shards`` using consistent hashing
+
+        Each shard can be a ``MongoDict`` or a ``dict`` with its parameters
+        (usually `host`, `port`, `database` and `collection`); ``kwargs`` are
+        used as defaults for all shards given as ``dict``. Shards are placed
+        in the hash ring `replicas` times each (so keys are evenly spread)
+        using their `host`, `port`, `database` and `collection`, so the
+        order of `shards` doesn't matter.
+        Operations over all shards (``len``, iteration, ``clear``, ``flush``
+        and the bulk ones) run in parallel, one thread per shard. Iteration
+        yields keys/pairs in no particular order.'''
+        super(ShardedMongoDict, self).__init__()
+        self._replicas = replicas
+        self._defaults = kwargs
+        self.shards = []
+        self._names = []
+        self._ring = []
+        for shard in shards:
+            self._add_to_ring(shard)
+
+    def _add_to_ring(self, shard):
+        if not isinstance(shard, MongoDict):
+            shard = MongoDict(**dict(self._defaults, **shard))
+        config = shard._config
+        name = u'{}:{}/{}/{}'.format(config['host'], config['port'],
+                                     config['database'], config['collection'])
+        if name in self._names:
+            raise ValueError(u'Error: shard {} already added'.format(name))
+        index = len(self.shards)
+        self.shards.append(shard)
+        self._names.append(name)
+        for replica in range(self._replicas):
+            point = _key_hash(u'{}#{}'.format(name, replica))
+            bisect.insort(self._ring, (point, index))
+        return shard
+
+    def _shard_index(self, key):
+        if not self._ring:
+            raise ValueError(u'Error: there are no shards')
+        position = bisect.bisect(self._ring, (_key_hash(key), ))
+        return self._ring[position % len(self._ring)][1]
+
+    def shard_for(self, key):
+        ''' Return the ``MongoDict`` which stores ``key`` '''
+        return self.shards[self._shard_index(key)]
+
+    def _group_by_shard(self, keys):
+        ''' Return a list of (shard, keys) for the shards owning ``keys`` '''
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._shard_index(key), []).append(key)
+        return [(self.shards[index], keys) for index, keys in groups.items()]
+
+    def __setitem__(self, key, value):
+        ''' Store the key/value pair in the shard of ``key`` '''
+        self.shard_for(key)[key] = value
+
+    def set(self, key, value, **kwargs):
+        ''' Store the key/value pair (see ``MongoDict.set``) '''
+        return self.shard_for(key).set(key, value, **kwargs)
+
+    def __getitem__(self, key):
+        ''' Retrieve the value for ``key`` from its shard '''
+        return self.shard_for(key)[key]
+
+    def get(self, key, default=None, read_from=None):
+        ''' Return the value for ``key`` (see ``MongoDict.get``) '''
+        return self.shard_for(key).get(key, default, read_from)
+
+    def __delitem__(self, key):
+        ''' Delete the key/value pair from the shard of ``key`` '''
+        del self.shard_for(key)[key]
+
+    def __contains__(self, key):
+        ''' Return True/False if a key is/is not stored '''
+        return key in self.shard_for(key)
+
+    has_key = __contains__
+
+    def __len__(self):
+        ''' Return how many key/value pairs are stored in all shards '''
+        return sum(_run_parallel(len, self.shards))
+
+    def clear(self):
+        ''' Delete all key/value pairs from all shards '''
+        _run_parallel(lambda shard: shard.clear(), self.shards)
+
+    def flush(self):
+        ''' Send buffered writes of all shards (see ``MongoDict.flush``) '''
+        return _run_parallel(lambda shard: shard.flush(), self.shards)
+
+    @contextlib.contextmanager
+    def write_concern(self, **options):
+        ''' Use the write concern ``options`` in all shards inside a ``with``
+        block (see ``MongoDict.write_concern``)
+        '''
+        options = _check_write_concern(options)
+        for shard in self.shards:
+            shard._write_concerns.append(options)
+        try:
+            yield self
+            self.flush()
+        finally:
+            for shard in self.shards:
+                shard._write_concerns.pop()
+
+    def __iter__(self):
+        ''' Iterate over all stored keys '''
+        return self.iterkeys()
+
+    def iterkeys(self, batch_size=ITER_BATCH_SIZE):
+        ''' Iterate over the keys of all shards (read in parallel) '''
+        return _iter_parallel(shard.iterkeys(batch_size)
+                              for shard in self.shards)
+
+    def iteritems(self, batch_size=ITER_BATCH_SIZE):
+        ''' Iterate over the (key, value) pairs of all shards (in parallel)
+        '''
+        return _iter_parallel(shard.iteritems(batch_size)
+                              for shard in self.shards)
+
+    def itervalues(self, batch_size=ITER_BATCH_SIZE):
+        ''' Iterate over the values of all shards (in parallel) '''
+        return (value for key, value in self.iteritems(batch_size))
+
+    if sys.version_info[0] == 2:
+        def items(self, batch_size=ITER_BATCH_SIZE):
+            ''' Return a list with all stored (key, value) pairs '''
+            return list(self.iteritems(batch_size))
+
+        def values(self, batch_size=ITER_BATCH_SIZE):
+            ''' Return a list with all stored values '''
+            return list(self.itervalues(batch_size))
+    else:
+        def items(self, batch_size=ITER_BATCH_SIZE):
+            ''' Return a view of all stored (key, value) pairs '''
+            return StreamingItemsView(self, batch_size)
+
+        def values(self, batch_size=ITER_BATCH_SIZE):
+            ''' Return a view of all stored values '''
+            return StreamingValuesView(self, batch_size)
+
+    def update(self, other=(), **kwargs):
+        ''' Update the dict with pairs from ``other`` and ``kwargs``
+
+        See ``set_many``.
+        '''
+        return self.set_many(_iter_pairs(other, kwargs))
+
+    def set_many(self, pairs, batch_size=BULK_BATCH_SIZE, **kwargs):
+        ''' Insert/update lots of pairs, writing to all shards in parallel
+
+        Pairs are grouped by shard and each group is sent with
+        ``MongoDict.set_many`` (``batch_size`` and ``kwargs`` are passed to
+        it). Return the list of per-batch results.
+        '''
+        results = []
+        groups = {}
+        pending = 0
+        max_pending = batch_size * max(len(self.shards), 1)
+        for key, value in _iter_pairs(pairs):
+            groups.setdefault(self._shard_index(key), {})[key] = value
+            pending += 1
+            if pending >= max_pending:
+                results.extend(self._set_groups(groups, batch_size, kwargs))
+                groups, pending = {}, 0
+        if groups:
+            results.extend(self._set_groups(groups, batch_size, kwargs))
+        return results
+
+    def _set_groups(self, groups, batch_size, kwargs):
+        results = _run_parallel(lambda group:
+                                self.shards[group[0]].set_many(group[1],
+                                        batch_size=batch_size, **kwargs),
+                                groups.items())
+        return [result for shard_results in results
+                       for result in shard_results]
+
+    def get_many(self, keys, default=_MISSING, read_from=None):
+        ''' Return a ``dict`` with the values for all ``keys``
+
+        Keys are grouped by shard and fetched in parallel (see
+        ``MongoDict.get_many``).
+        '''
+        result = {}
+        groups = self._group_by_shard(keys)
+        for values in _run_parallel(lambda group: group[0].get_many(group[1],
+                                                        default, read_from),
+                                    groups):
+            result.update(values)
+        return result
+
+    def contains_many(self, keys, read_from=None):
+        ''' Return a ``set`` with the ``keys`` that are stored '''
+        present = set()
+        groups = self._group_by_shard(keys)
+        for keys_found in _run_parallel(lambda group:
+                                        group[0].contains_many(group[1],
+                                                               read_from),
+                                        groups):
+            present.update(keys_found)
+        return present
+
+    def add_shard(self, shard, rebalance=True):
+        ''' Add a shard (``MongoDict`` or ``dict``, see ``__init__``)
+
+        With consistent hashing only the keys which now belong to the new
+        shard need to move; if ``rebalance``, they are moved now (see
+        ``rebalance``). Return the new shard.
+        '''
+        shard = self._add_to_ring(shard)
+        if rebalance:
+            self.rebalance()
+        return shard
+
+    def rebalance(self, batch_size=BULK_BATCH_SIZE):
+        ''' Move keys stored in the wrong shard to the right one
+
+        Keys of all shards are read in parallel, but only misplaced keys
+        have their documents (as stored, with codec, compression and
+        expiration) copied and deleted. Versions (see
+        ``MongoDict.get_with_version``) of moved keys are reset. Don't write
+        while rebalancing: a write to a key being moved may be lost. Return
+        how many keys were moved.
+        '''
+        self.flush()
+        return sum(_run_parallel(lambda index:
+                                 self._rebalance_shard(index, batch_size),
+                                 range(len(self.shards))))
+
+    def _rebalance_shard(self, index, batch_size):
+        source = self.shards[index]
+        moved = 0
+        misplaced = {}
+        for key in source.iterkeys(batch_size):
+            target = self._shard_index(key)
+            if target != index:
+                keys = misplaced.setdefault(target, [])
+                keys.append(key)
+                if len(keys) >= batch_size:
+                    moved += self._move_keys(source, self.shards[target], keys)
+                    del keys[:]
+        for target, keys in misplaced.items():
+            if keys:
+                moved += self._move_keys(source, self.shards[target], keys)
+        return moved
+
+    def _move_keys(self, source, target, keys):
+        source.round_trips += 1
+        documents = source._collection.find({'_id': {'$in': keys}})
+        operations = []
+        for document in _not_expired(documents):
+            document.pop('r', None)
+            if 'k' in document: # target will chunk it again if needed
+                document['v'] = Binary(b''.join(source._iter_chunks(document)))
+                del document['k'], document['l']
+            operations.append((document['_id'], document))
+        if not operations:
+            return 0
+        target._bulk_write(operations)
+        source._bulk_write([(key, _DELETED) for key, document in operations])
+        for shard in (source, target):
+            if shard._cache is not None:
+                for key, document in operations:
+                    shard._cache.discard(key)
+        return len(operations)
@@ -0,0 +1,140 @@
+# coding: utf-8
+
+''' asyncio interface for `mongodict <https://github.com/turicas/mongodict>`_
+
+``AsyncMongoDict`` runs ``MongoDict`` operations in a thread pool, so they do
+not block the event loop. As it uses ``MongoDict`` under the hood, documents
+and codecs are the same: both classes can share a collection. All threads
+share the ``MongoDict``'s connection pool, so many lookups can run
+concurrently.
+
+Requires Python 3.5+.
+'''
+
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mongodict import MongoDict, _MISSING
+
+
+__all__ = ['AsyncMongoDict']
+ITERATION_BATCH_SIZE = 1000
+
+
+class AsyncIterator(object):
+    ''' Iterate asynchronously over a blocking iterator, in batches
+
+    ``make_iterator`` is called (by ``run``, like the batches) only when the
+    first batch is needed, since creating the iterator can also block.
+    '''
+
+    def __init__(self, run, make_iterator, batch_size=ITERATION_BATCH_SIZE):
+        self._run = run
+        self._make_iterator = make_iterator
+        self._iterator = None
+        self._batch_size = batch_size
+        self._batch = []
+        self._exhausted = False
+
+    def _next_batch(self):
+        if self._iterator is None:
+            self._iterator = self._make_iterator()
+        batch = []
+        for item in self._iterator:
+            batch.append(item)
+            if len(batch) >= self._batch_size:
+                break
+        return batch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._batch and not self._exhausted:
+            self._batch = await self._run(self._next_batch)
+            self._batch.reverse()
+            self._exhausted = not self._batch
+        if not self._batch:
+            raise StopAsyncIteration
+        return self._batch.pop()
+
+
+class AsyncMongoDict(object):
+    ''' asyncio interface for ``MongoDict``
+
+    Accepts the same parameters as ``MongoDict``, plus ``max_workers`` (how
+    many operations can run at the same time) and ``loop``. Write-behind
+    buffering is not supported, since operations run in many threads.
+    '''
+
+    def __init__(self, max_workers=10, loop=None, **kwargs):
+        if kwargs.get('buffer_size') is not None or \
+           kwargs.get('buffer_timeout') is not None:
+            raise ValueError(u'Error: AsyncMongoDict does not support '
+                             u'write-behind buffering')
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.sync = MongoDict(**kwargs)
+
+    def _run(self, function, *args, **kwargs):
+        loop = self._loop or asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor,
+                                    functools.partial(function, *args,
+                                                      **kwargs))
+
+    async def get(self, key, default=None, read_from=None):
+        ''' Return the value for ``key`` or ``default`` if not found '''
+        return await self._run(self.sync.get, key, default, read_from)
+
+    async def set(self, key, value, **kwargs):
+        ''' Insert/update a key (see ``MongoDict.set``) '''
+        await self._run(self.sync.set, key, value, **kwargs)
+
+    async def delete(self, key):
+        ''' Delete the key/value for ``key``
+
+        If not found, raises ``KeyError``.
+        '''
+        await self._run(self.sync.__delitem__, key)
+
+    async def contains(self, key):
+        ''' Return True/False if a key is/is not stored '''
+        return await self._run(self.sync.__contains__, key)
+
+    async def len(self):
+        ''' Return how many key/value pairs are stored '''
+        return await self._run(self.sync.__len__)
+
+    async def get_many(self, keys, default=_MISSING, read_from=None):
+        ''' See ``MongoDict.get_many`` '''
+        return await self._run(self.sync.get_many, keys, default, read_from)
+
+    async def set_many(self, pairs, **kwargs):
+        ''' See ``MongoDict.set_many`` '''
+        return await self._run(self.sync.set_many, pairs, **kwargs)
+
+    async def clear(self):
+        ''' Delete all key/value pairs '''
+        await self._run(self.sync.clear)
+
+    def keys(self, batch_size=ITERATION_BATCH_SIZE):
+        ''' Asynchronously iterate over all stored keys '''
+        return AsyncIterator(self._run,
+                             functools.partial(self.sync.iterkeys,
+                                               batch_size),
+                             batch_size)
+
+    def items(self, batch_size=ITERATION_BATCH_SIZE):
+        ''' Asynchronously iterate over all stored (key, value) pairs '''
+        return AsyncIterator(self._run,
+                             functools.partial(self.sync.iteritems,
+                                               batch_size),
+                             batch_size)
+
+    __aiter__ = keys
+
+    def close(self):
+        ''' Wait for running operations and stop the thread pool '''
+        self._executor.shutdown(wait=True)
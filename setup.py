@@ -8,6 +8,9 @@ if sys.version_info[0] == 3:
     author_name = 'Álvaro Justen'
 else:
     author_name = 'Álvaro Justen'.decode('utf-8')
+modules = ['mongodict']
+if sys.version_info >= (3, 5): # mongodict_async uses async/await syntax
+    modules.append('mongodict_async')
 
 setup(name='mongodict',
       version='0.3.1',
@@ -15,8 +18,8 @@ setup(name='mongodict',
       author_email='alvarojusten@gmail.com',
       url='https://github.com/turicas/mongodict/',
       description='MongoDB-backed Python dict-like interface',
-      py_modules=['mongodict'],
-      install_requires=['pymongo'],
+      py_modules=modules,
+      install_requires=['pymongo>=2.7,<3'],
       license='GPL3',
       keywords=['key-value', 'database', 'mongodb', 'dictionary'],
       classifiers=[
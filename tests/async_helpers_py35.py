@@ -0,0 +1,11 @@
+# coding: utf-8
+
+''' Helpers with async syntax, for tests which run only on Python 3.5+ '''
+
+
+async def collect(async_iterator):
+    ''' Return a list with all the items of ``async_iterator`` '''
+    items = []
+    async for item in async_iterator:
+        items.append(item)
+    return items
@@ -11,7 +11,7 @@ else:
 
 import pymongo
 
-from mongodict import MongoDict
+from mongodict import MongoDict, close_clients
 
 
 MONGO_HOST = '127.0.0.1'
@@ -33,6 +33,7 @@ class TestMappingProtocol(mapping_tests.BasicTestMappingProtocol):
     def tearDown(self):
         for collection in self.collections:
             self._db.drop_collection(collection)
+        close_clients()
 
     def type2test(self):
         collection_name = random_string()
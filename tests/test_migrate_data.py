@@ -0,0 +1,98 @@
+# coding: utf-8
+
+import time
+import unittest
+
+import pymongo
+
+import migrate_data
+
+from mongodict import MongoDict, close_clients
+
+
+class TestMigrateData(unittest.TestCase):
+    def setUp(self):
+        self.config_old = {'host': 'localhost', 'port': 27017,
+                           'database': 'mongodict_migration',
+                           'collection': 'old',}
+        self.config_new = dict(self.config_old, collection='new')
+        self.connection = pymongo.Connection(host=self.config_old['host'],
+                port=self.config_old['port'], safe=True)
+        self.db = self.connection[self.config_old['database']]
+        self.old = self.db[self.config_old['collection']]
+        self.old.insert([{'_id': 'key-{:04d}'.format(number),
+                          'value': number} for number in range(1000)])
+
+    def tearDown(self):
+        self.connection.drop_database(self.db)
+        close_clients()
+
+    def test_ids_at_positions_should_follow_id_order(self):
+        self.assertEqual(migrate_data.ids_at_positions(self.old,
+                                                       [0, 10, 999]),
+                         ['key-0000', 'key-0010', 'key-0999'])
+        self.assertEqual(migrate_data.ids_at_positions(self.old, []), [])
+
+    def test_split_id_space_should_cover_all_ids(self):
+        ranges = migrate_data.split_id_space(self.old, 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertIsNone(ranges[0][0])
+        self.assertIsNone(ranges[-1][1])
+        for (lower, upper), (next_lower, next_upper) in zip(ranges[:-1],
+                                                            ranges[1:]):
+            self.assertEqual(upper, next_lower)
+        self.assertEqual(migrate_data.split_id_space(self.old, 1),
+                         [(None, None)])
+
+    def test_killed_migration_should_be_resumed_from_checkpoints(self):
+        state = migrate_data.start_state('codec', self.config_old,
+                                         self.config_new, 2, resume=False)
+        self.assertEqual(len(state['ranges']), 2 *
+                         migrate_data.RANGES_PER_WORKER)
+        # a worker migrates one batch of the first range and is killed
+        new_dict = MongoDict(**self.config_new)
+        checkpoint = migrate_data.Checkpoint(
+                migrate_data.get_state_collection(self.config_new),
+                state['_id'], 0)
+        batch = [(document['_id'], document['value'])
+                 for document in self.old.find().sort('_id', 1).limit(50)]
+        migrate_data.write_batch(new_dict, batch, 0, time.time(), None,
+                                 checkpoint)
+
+        state = migrate_data.start_state('codec', self.config_old,
+                                         self.config_new, 2, resume=True)
+        self.assertEqual(state['ranges'][0]['last'], 'key-0049')
+        self.assertEqual(state['ranges'][0]['migrated'], 50)
+        migrated = migrate_data.migrate('codec', self.config_old,
+                                        self.config_new, workers=2,
+                                        batch_size=100, resume=True)
+        self.assertEqual(migrated, 1000)
+        self.assertEqual(len(new_dict), 1000)
+        self.assertEqual(new_dict['key-0123'], 123)
+        state = migrate_data.get_state_collection(self.config_new)\
+                            .find_one({'_id': state['_id']})
+        self.assertTrue(all(id_range['done'] for id_range in state['ranges']))
+        self.assertEqual(sum(id_range['migrated']
+                             for id_range in state['ranges']), 1000)
+        self.assertTrue(migrate_data.verify('codec', self.config_old,
+                                            self.config_new, samples=100))
+        del new_dict['key-0500']
+        self.assertFalse(migrate_data.verify('codec', self.config_old,
+                                             self.config_new, samples=1000))
+
+    def test_parallel_migration_should_respect_max_rate(self):
+        start_time = time.time()
+        migrated = migrate_data.migrate('codec', self.config_old,
+                                        self.config_new, workers=2,
+                                        batch_size=50, max_rate=1000)
+        elapsed = time.time() - start_time
+        self.assertEqual(migrated, 1000)
+        new_dict = MongoDict(**self.config_new)
+        self.assertEqual(len(new_dict), 1000)
+        self.assertEqual(new_dict['key-0000'], 0)
+        self.assertEqual(new_dict['key-0999'], 999)
+        self.assertTrue(migrate_data.verify('codec', self.config_old,
+                                            self.config_new, samples=100))
+        # 1000 keys at 1000 keys/s: each worker sleeps to keep its share
+        self.assertGreaterEqual(elapsed, 0.9)
+        self.assertLess(elapsed, 10)
@@ -1,8 +1,12 @@
 # coding: utf-8
 
+import datetime
 import json
+import multiprocessing
+import os
 import pickle
 import sys
+import time
 import unittest
 
 from collections import MutableMapping
@@ -10,7 +14,9 @@ from collections import MutableMapping
 import pymongo
 
 from bson import Binary
-from mongodict import MongoDict
+from mongodict import (CacheInvalidator, LRUCache, MongoDict,
+                       ShardedMongoDict, VersionConflict, _split_keys,
+                       close_clients, get_client, register_codec)
 
 
 if sys.version_info[0] < 3: # Python 2
@@ -31,6 +37,10 @@ def decode(value):
     return pickle.loads(value)
 
 
+def set_pid_item(my_dict):
+    my_dict[str(os.getpid())] = my_dict['parent']
+
+
 def extract_indexes(index_info):
     return [idx['key'] for idx in index_info.values()]
 
@@ -47,6 +57,7 @@ class TestMongoDict(unittest.TestCase):
 
     def tearDown(self):
         self.connection.drop_database(self.db)
+        close_clients() # so indexes are created again in the next test
 
     def test_set_item_should_save_data_in_collection(self):
         my_dict = MongoDict(**self.config)
@@ -183,4 +194,949 @@ class TestMongoDict(unittest.TestCase):
             new_indexes.add(tuple(index))
         self.assertEqual(new_indexes, expected_indexes)
 
+    def test_get_many_should_return_only_existing_keys(self):
+        my_dict = MongoDict(**self.config)
+        my_dict['a'] = 1
+        my_dict['b'] = [2, 3]
+        self.assertEqual(my_dict.get_many(['a', 'b', 'c']),
+                         {'a': 1, 'b': [2, 3]})
+        self.assertEqual(my_dict.get_many(['a', 'c'], default=None),
+                         {'a': 1, 'c': None})
+        self.assertEqual(my_dict.get_many([]), {})
+
+    def test_get_many_should_split_large_key_lists(self):
+        my_dict = MongoDict(**self.config)
+        keys = ['key-{}'.format(i) for i in range(2500)]
+        my_dict.update((key, key.upper()) for key in keys)
+        result = my_dict.get_many(keys + ['missing'])
+        self.assertEqual(len(result), 2500)
+        self.assertEqual(result['key-2499'], 'KEY-2499')
+
+    def test_split_keys_should_respect_count_and_byte_limits(self):
+        batches = list(_split_keys(['a', 'b', 'c'], max_keys=2))
+        self.assertEqual(batches, [['a', 'b'], ['c']])
+        batches = list(_split_keys(['aaa', 'bbb', 'c'], max_bytes=4))
+        self.assertEqual(batches, [['aaa'], ['bbb', 'c']])
+
+    def test_contains_many_should_return_set_of_stored_keys(self):
+        my_dict = MongoDict(**self.config)
+        my_dict['a'] = 1
+        my_dict['b'] = 2
+        self.assertEqual(my_dict.contains_many(['a', 'b', 'c']),
+                         set(['a', 'b']))
+
+    def test_set_many_should_send_pairs_in_batches(self):
+        my_dict = MongoDict(**self.config)
+        pairs = [('key-{}'.format(i), i) for i in range(25)]
+        results = my_dict.set_many(pairs, batch_size=10)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(sum(result['nUpserted'] for result in results), 25)
+        self.assertEqual(self.collection.find().count(), 25)
+        self.assertEqual(my_dict['key-24'], 24)
+
+    def test_set_many_should_keep_last_value_of_repeated_keys(self):
+        my_dict = MongoDict(**self.config)
+        my_dict.set_many([('a', 1), ('b', 2), ('a', 3)])
+        self.assertEqual(my_dict['a'], 3)
+        my_dict.update({'a': 4}, b=5)
+        self.assertEqual(my_dict['a'], 4)
+        self.assertEqual(my_dict['b'], 5)
+
+    def test_buffered_writes_should_be_visible_before_flush(self):
+        my_dict = MongoDict(buffer_size=100, **self.config)
+        my_dict['a'] = 1
+        my_dict['a'] = 2
+        my_dict['b'] = 3
+        del my_dict['b']
+        self.assertEqual(self.collection.find().count(), 0)
+        self.assertEqual(my_dict['a'], 2)
+        self.assertIn('a', my_dict)
+        self.assertNotIn('b', my_dict)
+        with self.assertRaises(KeyError):
+            temp = my_dict['b']
+        self.assertEqual(my_dict.get_many(['a', 'b']), {'a': 2})
+        my_dict.flush()
+        results = list(self.collection.find())
+        self.assertEqual(len(results), 1)
+        self.assertEqual(decode(results[0]['v']), 2)
+
+    def test_buffered_writes_should_flush_when_size_limit_is_reached(self):
+        my_dict = MongoDict(buffer_size=10, **self.config)
+        for i in range(9):
+            my_dict['key-{}'.format(i)] = i
+        self.assertEqual(self.collection.find().count(), 0)
+        my_dict['key-9'] = 9
+        self.assertEqual(self.collection.find().count(), 10)
+
+    def test_buffered_writes_should_flush_when_time_limit_is_reached(self):
+        my_dict = MongoDict(buffer_timeout=0, **self.config)
+        my_dict['a'] = 1
+        self.assertEqual(self.collection.find().count(), 1)
+
+    def test_buffered_writes_should_be_flushed_even_if_writes_stop(self):
+        my_dict = MongoDict(buffer_timeout=0.2, **self.config)
+        my_dict['a'] = 1
+        self.assertEqual(self.collection.find().count(), 0)
+        deadline = time.time() + 5
+        while self.collection.find().count() == 0 and \
+              time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.collection.find().count(), 1)
+        self.assertEqual(my_dict._pending, {})
+        thread = my_dict._flusher._thread
+        del my_dict # the flusher thread does not keep it alive
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_cache_should_serve_hot_keys_without_querying(self):
+        my_dict = MongoDict(cache_size=10, **self.config)
+        self.collection.insert({'_id': 'a', 'v': Binary(encode([1, 2]))})
+        self.assertEqual(my_dict['a'], [1, 2])
+        self.collection.remove({'_id': 'a'})
+        self.assertEqual(my_dict['a'], [1, 2]) # served from cache
+        info = my_dict.cache_info()
+        self.assertEqual((info['hits'], info['misses']), (1, 1))
+
+    def test_cache_should_be_updated_on_writes_and_deletes(self):
+        my_dict = MongoDict(cache_size=10, **self.config)
+        my_dict['a'] = 1
+        my_dict['a'] = 2
+        self.assertEqual(my_dict['a'], 2)
+        del my_dict['a']
+        with self.assertRaises(KeyError):
+            temp = my_dict['a']
+        my_dict['b'] = 3
+        my_dict.clear()
+        self.assertNotIn('b', my_dict)
+        self.assertEqual(my_dict.cache_info()['entries'], 0)
+
+    def test_lru_cache_should_evict_least_recently_used_entries(self):
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1, 10)
+        cache.put('b', 2, 10)
+        cache.get('a')
+        cache.put('c', 3, 10)
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertEqual(cache.evictions, 1)
+
+        cache = LRUCache(max_bytes=25)
+        cache.put('a', 1, 10)
+        cache.put('b', 2, 10)
+        cache.put('c', 3, 10)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 20)
+        cache.put('d', 4, 100) # bigger than the whole cache
+        self.assertNotIn('d', cache)
+
+    def test_cache_invalidator_should_discard_changed_keys(self):
+        cache = LRUCache()
+        for key in 'abcd':
+            cache.put(key, 1, 1)
+        invalidator = CacheInvalidator(cache, self.collection)
+        invalidator.handle({'op': 'i', 'o': {'_id': 'a'}})
+        invalidator.handle({'op': 'u', 'o2': {'_id': 'b'}, 'o': {}})
+        invalidator.handle({'op': 'd', 'o': {'_id': 'c'}})
+        self.assertEqual(len(cache), 1)
+        invalidator.handle({'op': 'c', 'o': {'drop': 'main'}})
+        self.assertEqual(len(cache), 0)
+
+    def test_cache_invalidation_should_only_affect_changed_keys(self):
+        cache = LRUCache()
+        generation = cache.generation
+        cache.invalidate('a')
+        cache.put('b', 'fresh', 1, generation) # read while `a` changed
+        self.assertIn('b', cache)
+        cache.put('a', 'stale', 1, generation, version=1)
+        self.assertNotIn('a', cache)
+        generation = cache.generation
+        cache.invalidate('c', version=3)
+        cache.put('c', 'new', 1, generation, version=3) # read the change
+        self.assertIn('c', cache)
+        cache.invalidate('c', version=3) # own write, seen in the oplog
+        self.assertIn('c', cache)
+        cache.invalidate('c', version=4)
+        self.assertNotIn('c', cache)
+        generation = cache.generation
+        cache.invalidate()
+        cache.put('b', 'stale', 1, generation)
+        self.assertNotIn('b', cache)
+
+    def test_cache_invalidator_should_keep_values_of_same_version(self):
+        cache = LRUCache()
+        cache.put('a', 1, 1, version=2)
+        cache.put('b', 1, 1, version=2)
+        invalidator = CacheInvalidator(cache, self.collection)
+        invalidator.handle({'op': 'u', 'o2': {'_id': 'a'},
+                            'o': {'$set': {'v': 1, 'r': 2}}})
+        invalidator.handle({'op': 'u', 'o2': {'_id': 'b'},
+                            'o': {'$set': {'v': 2, 'r': 3}}})
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+    def test_cache_invalidator_should_watch_collection_commands(self):
+        invalidator = CacheInvalidator(LRUCache(), self.collection)
+        namespace = self.collection.full_name
+        commands = self.db.name + '.$cmd'
+        oplog = self.db['fake_oplog']
+        oplog.insert([{'_id': 1, 'ns': namespace, 'op': 'i'},
+                      {'_id': 2, 'ns': commands, 'op': 'c',
+                       'o': {'drop': self.collection.name}},
+                      {'_id': 3, 'ns': commands, 'op': 'c',
+                       'o': {'dropDatabase': 1}},
+                      {'_id': 4, 'ns': 'admin.$cmd', 'op': 'c',
+                       'o': {'renameCollection': namespace, 'to': 'x.y'}},
+                      {'_id': 5, 'ns': 'admin.$cmd', 'op': 'c',
+                       'o': {'renameCollection': 'x.y', 'to': namespace}},
+                      {'_id': 6, 'ns': namespace + '2', 'op': 'i'},
+                      {'_id': 7, 'ns': commands, 'op': 'c',
+                       'o': {'drop': 'other'}},
+                      {'_id': 8, 'ns': 'admin.$cmd', 'op': 'c',
+                       'o': {'renameCollection': 'x.y', 'to': 'x.z'}}])
+        entries = oplog.find(invalidator._query(None))
+        self.assertEqual(sorted(entry['_id'] for entry in entries),
+                         [1, 2, 3, 4, 5])
+
+    def test_cache_should_not_store_values_read_before_invalidation(self):
+        cache = LRUCache()
+        generation = cache.generation
+        cache.invalidate('a')
+        cache.put('a', 'stale', 1, generation)
+        self.assertNotIn('a', cache)
+
+    def test_watch_changes_should_invalidate_keys_changed_elsewhere(self):
+        if 'setName' not in self.connection.admin.command('ismaster'):
+            self.skipTest('MongoDB server is not a replica set')
+        writer = MongoDict(**self.config)
+        reader = MongoDict(cache_size=10, **self.config)
+        writer['a'] = 1
+        self.assertEqual(reader['a'], 1)
+        reader.watch_changes()
+        try:
+            time.sleep(0.5) # wait for the listener to start tailing
+            writer['a'] = 2
+            deadline = time.time() + 10
+            while reader['a'] != 2 and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertEqual(reader['a'], 2)
+        finally:
+            reader.stop_watching_changes()
+
+    def test_core_operations_should_use_one_round_trip(self):
+        my_dict = MongoDict(**self.config)
+        operations = [lambda: my_dict.__setitem__('a', 1),
+                      lambda: my_dict['a'],
+                      lambda: 'a' in my_dict,
+                      lambda: 'b' in my_dict,
+                      lambda: len(my_dict),
+                      lambda: my_dict.__delitem__('a')]
+        for operation in operations:
+            round_trips = my_dict.round_trips
+            operation()
+            self.assertEqual(my_dict.round_trips - round_trips, 1)
+
+        round_trips = my_dict.round_trips
+        with self.assertRaises(KeyError):
+            temp = my_dict['a']
+        with self.assertRaises(KeyError):
+            del my_dict['a']
+        self.assertEqual(my_dict.round_trips - round_trips, 2)
+
+    def test_del_item_should_raise_KeyError_even_without_safe(self):
+        config = self.config.copy()
+        config['safe'] = False
+        my_dict = MongoDict(**config)
+        my_dict['a'] = 1
+        del my_dict['a']
+        with self.assertRaises(KeyError):
+            del my_dict['a']
+
+    def test_instances_should_share_connection_pool(self):
+        my_dict = MongoDict(**self.config)
+        other_dict = MongoDict(database='other', collection='other',
+                               host=self.config['host'],
+                               port=self.config['port'])
+        self.assertIs(my_dict._connection, other_dict._connection)
+        self.assertIs(my_dict._connection, get_client(self.config['host'],
+                                                      self.config['port']))
+        small_pool = MongoDict(max_pool_size=5, socket_timeout=10,
+                               **self.config)
+        self.assertIsNot(my_dict._connection, small_pool._connection)
+        self.connection.drop_database('other')
+
+    def test_deletion_of_MongoDict_object_should_not_disconnect_others(self):
+        my_dict = MongoDict(**self.config)
+        other_dict = MongoDict(**self.config)
+        del other_dict
+        my_dict['a'] = 1
+        self.assertEqual(my_dict['a'], 1)
+
+    def test_should_reconnect_in_forked_processes(self):
+        my_dict = MongoDict(**self.config)
+        my_dict['parent'] = 'yes'
+        parent_client = my_dict._connection
+        pid = os.fork()
+        if pid == 0: # child
+            try:
+                assert my_dict._connection is not parent_client
+                my_dict['child'] = my_dict['parent']
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertIs(my_dict._connection, parent_client)
+        self.assertEqual(my_dict['child'], 'yes')
+
+    def test_pickle_should_store_only_configuration(self):
+        my_dict = MongoDict(cache_size=10, **self.config)
+        my_dict['python'] = 'rules'
+        serialized = pickle.dumps(my_dict)
+        self.assertNotIn(b'rules', serialized)
+        new_dict = pickle.loads(serialized)
+        self.assertEqual(new_dict['python'], 'rules')
+        self.assertEqual(new_dict._config, my_dict._config)
+
+    def test_should_be_sent_to_worker_processes(self):
+        my_dict = MongoDict(**self.config)
+        my_dict['parent'] = 'yes'
+        pool = multiprocessing.Pool(2)
+        pool.map(set_pid_item, [my_dict] * 4)
+        pool.close()
+        pool.join()
+        self.assertTrue(2 <= len(my_dict) <= 5)
+
+    def test_named_codecs_should_be_stored_in_documents(self):
+        for codec in ('pickle', 'marshal', 'json'):
+            self.config['codec'] = codec
+            my_dict = MongoDict(**self.config)
+            my_dict[codec] = {'answer': [42]}
+            self.assertEqual(my_dict[codec], {'answer': [42]})
+            document = self.collection.find_one({'_id': codec})
+            self.assertEqual(document['c'], codec)
+        self.config['codec'] = 'raw'
+        raw_dict = MongoDict(**self.config)
+        raw_dict['raw'] = b'\x00\x01'
+        self.assertEqual(raw_dict['raw'], b'\x00\x01')
+        with self.assertRaises(TypeError):
+            raw_dict['raw'] = 42
+        # documents written by other codecs are still readable
+        self.assertEqual(raw_dict['json'], {'answer': [42]})
+        self.assertEqual(raw_dict.get_many(['pickle', 'marshal']),
+                         {'pickle': {'answer': [42]},
+                          'marshal': {'answer': [42]}})
+        self.config['codec'] = 'unknown'
+        with self.assertRaises(ValueError):
+            MongoDict(**self.config)
+
+    def test_bson_codec_should_store_native_values_as_is(self):
+        self.config['codec'] = 'bson'
+        my_dict = MongoDict(**self.config)
+        values = {'int': 42, 'float': 3.14, 'text': key_1, 'none': None,
+                  'bool': True, 'big': 2 ** 70, 'list': [1, 2]}
+        my_dict.update(values)
+        for key, value in values.items():
+            self.assertEqual(my_dict[key], value)
+            self.assertEqual(type(my_dict[key]), type(value))
+        self.assertEqual(self.collection.find_one({'_id': 'int'})['v'], 42)
+        document = self.collection.find_one({'_id': 'list'})
+        self.assertEqual(document['c'], 'pickle')
+        document = self.collection.find_one({'_id': 'big'})
+        self.assertEqual(document['c'], 'pickle')
+
+    def test_register_codec(self):
+        register_codec('upper', lambda x: x.upper().encode('utf-8'),
+                       lambda x: x.decode('utf-8'))
+        self.config['codec'] = 'upper'
+        my_dict = MongoDict(**self.config)
+        my_dict['python'] = 'rules'
+        self.assertEqual(my_dict['python'], 'RULES')
+        with self.assertRaises(ValueError):
+            register_codec('bson', encode, decode)
+
+    def test_compression_should_apply_only_above_threshold(self):
+        my_dict = MongoDict(compression='zlib', compression_threshold=100,
+                            **self.config)
+        big_value = {'data': 'python rules! ' * 1000}
+        my_dict['big'] = big_value
+        my_dict['small'] = 'python'
+        big_document = self.collection.find_one({'_id': 'big'})
+        small_document = self.collection.find_one({'_id': 'small'})
+        self.assertEqual(big_document['z'], 'zlib')
+        self.assertLess(len(big_document['v']), len(encode(big_value)))
+        self.assertNotIn('z', small_document)
+        self.assertEqual(my_dict['big'], big_value)
+        self.assertEqual(my_dict['small'], 'python')
+        info = my_dict.compression_info()
+        self.assertEqual(info['compressed'], 1)
+        self.assertEqual(info['decompressed'], 1)
+        self.assertGreater(info['ratio'], 5)
+
+    def test_compressed_and_uncompressed_documents_can_be_read_together(self):
+        self.collection.insert({'_id': 'old', 'v': Binary(encode('old'))})
+        config = self.config.copy()
+        config['compression'] = 'bz2'
+        config['compression_threshold'] = 0
+        my_dict = MongoDict(**config)
+        my_dict['new'] = 'new' * 100
+        plain_dict = MongoDict(**self.config)
+        self.assertEqual(plain_dict.get_many(['old', 'new']),
+                         {'old': 'old', 'new': 'new' * 100})
+        config['compression'] = 'invalid'
+        with self.assertRaises(ValueError):
+            MongoDict(**config)
+
+    def test_big_values_should_be_stored_in_chunks(self):
+        my_dict = MongoDict(chunk_threshold=1000, chunk_size=300,
+                            **self.config)
+        chunks = self.db[self.config['collection'] + '.chunks']
+        big_value = list(range(1000))
+        my_dict['big'] = big_value
+        my_dict['small'] = 'python'
+        document = self.collection.find_one({'_id': 'big'})
+        self.assertNotIn('v', document)
+        self.assertEqual(document['l'], len(encode(big_value)))
+        self.assertEqual(chunks.find({'f': 'big'}).count(),
+                         (document['l'] + 299) // 300)
+        self.assertEqual(my_dict['big'], big_value)
+        self.assertEqual(my_dict.get_many(['big', 'small']),
+                         {'big': big_value, 'small': 'python'})
+
+        my_dict['big'] = list(range(2000)) # old chunks are removed
+        document = self.collection.find_one({'_id': 'big'})
+        self.assertEqual(chunks.find().count(), (document['l'] + 299) // 300)
+        self.assertEqual(my_dict['big'], list(range(2000)))
+        del my_dict['big']
+        self.assertEqual(chunks.find().count(), 0)
+
+    def test_chunks_should_be_removed_when_value_becomes_small(self):
+        my_dict = MongoDict(chunk_threshold=1000, chunk_size=300,
+                            **self.config)
+        chunks = self.db[self.config['collection'] + '.chunks']
+        my_dict['big'] = list(range(1000))
+        my_dict['big'] = 'small'
+        self.assertEqual(chunks.find().count(), 0)
+        self.assertEqual(my_dict['big'], 'small')
+        del my_dict['big']
+        my_dict.update({'a': list(range(1000)), 'b': list(range(1000))})
+        my_dict.update({'a': 'small', 'b': list(range(2000))})
+        self.assertEqual(chunks.find({'f': 'a'}).count(), 0)
+        self.assertEqual(chunks.find({'f': 'b'}).distinct('s'),
+                         [self.collection.find_one({'_id': 'b'})['k']])
+        my_dict.update({'b': 'small'})
+        del my_dict['a']
+        del my_dict['b']
+        self.assertEqual(chunks.find().count(), 0)
+        with my_dict.write_concern(w=1, wtimeout=1000):
+            my_dict['c'] = list(range(1000))
+            my_dict['c'] = 'small'
+        self.assertEqual(chunks.find().count(), 0)
+
+    def test_values_bigger_than_16MB_should_be_stored(self):
+        my_dict = MongoDict(**self.config)
+        big_value = b'python' * (4 * 1024 * 1024) # 24MB
+        my_dict['big'] = big_value
+        self.assertEqual(my_dict['big'], big_value)
+
+    def test_open_value_should_stream_encoded_value(self):
+        self.config['codec'] = 'raw'
+        my_dict = MongoDict(chunk_threshold=1000, chunk_size=300,
+                            compression='zlib', **self.config)
+        big_value = b''.join(str(i).encode('ascii') for i in range(10000))
+        my_dict['big'] = big_value
+        value_file = my_dict.open_value('big')
+        self.assertEqual(value_file.read(10), big_value[:10])
+        self.assertEqual(value_file.read(), big_value[10:])
+        self.config['codec'] = 'pickle'
+        pickle_dict = MongoDict(chunk_threshold=1000, chunk_size=300,
+                                **self.config)
+        pickle_dict['list'] = list(range(1000))
+        self.assertEqual(pickle.load(pickle_dict.open_value('list')),
+                         list(range(1000)))
+        with self.assertRaises(KeyError):
+            my_dict.open_value('missing')
+
+    def test_items_and_values_should_use_only_one_cursor(self):
+        my_dict = MongoDict(**self.config)
+        data = dict(('key-{}'.format(i), [i]) for i in range(100))
+        my_dict.update(data)
+        round_trips = my_dict.round_trips
+        self.assertEqual(dict(my_dict.items(batch_size=10)), data)
+        self.assertEqual(sorted(my_dict.values()),
+                         sorted(data.values()))
+        self.assertEqual(dict(my_dict.iteritems()), data)
+        self.assertEqual(my_dict.round_trips - round_trips, 3)
+        self.assertIn([42], my_dict.values())
+        self.assertNotIn([420], my_dict.values())
+
+    def test_iteritems_should_decode_values_lazily(self):
+        my_dict = MongoDict(**self.config)
+        my_dict['a'] = 1
+        self.collection.insert({'_id': 'b', 'v': Binary(b'invalid')})
+        pairs = my_dict.iteritems(batch_size=1)
+        self.assertEqual(next(pairs), ('a', 1))
+        with self.assertRaises(Exception):
+            next(pairs)
+
+    def test_iter_prefix_should_return_only_keys_with_prefix(self):
+        my_dict = MongoDict(**self.config)
+        my_dict.update({'user:1:name': 'a', 'user:1:age': 1,
+                        'user:10:name': 'b', 'user:2:name': 'c',
+                        'user;': 'd', 'users': 'e'})
+        self.assertEqual(list(my_dict.iter_prefix('user:1:')),
+                         [('user:1:age', 1), ('user:1:name', 'a')])
+        self.assertEqual(list(my_dict.iter_prefix('user:', keys_only=True,
+                                                  reverse=True, limit=2)),
+                         ['user:2:name', 'user:10:name'])
+        self.assertEqual(list(my_dict.iter_prefix('nothing')), [])
+
+    def test_bytes_prefix_should_match_only_on_python_2(self):
+        my_dict = MongoDict(**self.config)
+        my_dict.update({'user:1:name': 'a', 'users': 'b'})
+        if sys.version_info[0] < 3: # `str` keys are stored as strings
+            self.assertEqual(list(my_dict.iter_prefix(b'user:')),
+                             [('user:1:name', 'a')])
+        else: # `bytes` keys are stored as BSON binary
+            with self.assertRaises(ValueError):
+                my_dict.iter_prefix(b'user:')
+            with self.assertRaises(ValueError):
+                my_dict.delete_prefix(b'user:')
+            self.assertEqual(len(my_dict), 2)
+
+    def test_iter_range_should_use_key_bounds(self):
+        my_dict = MongoDict(**self.config)
+        my_dict.update((key, key.upper()) for key in 'abcdef')
+        self.assertEqual(list(my_dict.iter_range('b', 'e')),
+                         [('b', 'B'), ('c', 'C'), ('d', 'D')])
+        self.assertEqual(list(my_dict.iter_range(stop='c', keys_only=True)),
+                         ['a', 'b'])
+        self.assertEqual(list(my_dict.iter_range('e', reverse=True,
+                                                 keys_only=True)),
+                         ['f', 'e'])
+
+    def test_delete_prefix_should_delete_only_keys_with_prefix(self):
+        my_dict = MongoDict(cache_size=10, **self.config)
+        my_dict.update({'user:1:name': 'a', 'user:1:age': 1,
+                        'user:10:name': 'b'})
+        self.assertEqual(my_dict['user:1:age'], 1) # cached
+        self.assertEqual(my_dict.delete_prefix('user:1:'), 2)
+        self.assertNotIn('user:1:age', my_dict)
+        self.assertEqual(list(my_dict.keys()), ['user:10:name'])
+
+    def test_approximate_len_should_use_collection_metadata(self):
+        my_dict = MongoDict(approximate_len=True, **self.config)
+        my_dict.update((str(i), i) for i in range(10))
+        round_trips = my_dict.round_trips
+        self.assertEqual(len(my_dict), 10)
+        self.assertEqual(my_dict.round_trips - round_trips, 1)
+        self.assertEqual(my_dict.count(approximate=False), 10)
+
+    def test_cached_len_should_be_updated_by_own_writes(self):
+        my_dict = MongoDict(len_cache_ttl=60, **self.config)
+        self.assertEqual(len(my_dict), 0)
+        round_trips = my_dict.round_trips
+        my_dict['a'] = 1
+        my_dict['a'] = 2 # not a new key
+        my_dict.update({'b': 2, 'c': 3})
+        del my_dict['c']
+        # `update` also removes old chunks of its keys
+        self.assertEqual(my_dict.round_trips - round_trips, 5)
+        self.assertEqual(len(my_dict), 2)
+        self.assertEqual(my_dict.round_trips - round_trips, 5)
+        self.collection.insert({'_id': 'other', 'v': Binary(encode(1))})
+        self.assertEqual(len(my_dict), 2) # other writers are not seen...
+        my_dict._cached_len_time -= 61
+        self.assertEqual(len(my_dict), 3) # ...until cache expires
+        my_dict.clear()
+        self.assertEqual(len(my_dict), 0)
+
+    def test_exact_count_should_not_use_cached_approximate_len(self):
+        my_dict = MongoDict(approximate_len=True, len_cache_ttl=60,
+                            **self.config)
+        my_dict['a'] = 1
+        len(my_dict) # caches the approximate length
+        my_dict._cached_len = 42 # so we know when it is used
+        self.assertEqual(len(my_dict), 42)
+        self.assertEqual(my_dict.count(approximate=True), 42)
+        round_trips = my_dict.round_trips
+        self.assertEqual(my_dict.count(), 1)
+        self.assertEqual(my_dict.round_trips, round_trips + 1)
+        self.assertEqual(len(my_dict), 1) # the exact count is cached
+
+    def test_incr_should_update_counters_on_server(self):
+        my_dict = MongoDict(**self.config)
+        round_trips = my_dict.round_trips
+        self.assertEqual(my_dict.incr('hits'), 1)
+        self.assertEqual(my_dict.incr('hits', 10), 11)
+        self.assertEqual(my_dict.decr('hits', 2), 9)
+        self.assertEqual(my_dict.round_trips - round_trips, 3)
+        self.assertEqual(my_dict['hits'], 9)
+        document = self.collection.find_one({'_id': 'hits'})
+        self.assertEqual(document['v'], 9)
+        self.assertEqual(my_dict.incr('float', 0.5), 0.5)
+        my_dict['not a number'] = 'python'
+        with self.assertRaises(pymongo.errors.OperationFailure):
+            my_dict.incr('not a number')
+
+    def test_incr_should_not_lose_concurrent_updates(self):
+        my_dict = MongoDict(**self.config)
+        other_dict = MongoDict(**self.config)
+        for i in range(10):
+            my_dict.incr('counter')
+            other_dict.incr('counter')
+        self.assertEqual(my_dict['counter'], 20)
+
+    def test_incr_many_should_use_bulk_increments(self):
+        my_dict = MongoDict(cache_size=10, **self.config)
+        my_dict.incr('a', 5)
+        results = my_dict.incr_many([('a', 1), ('b', 2), ('c', 3)],
+                                    batch_size=2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(my_dict.get_many(['a', 'b', 'c']),
+                         {'a': 6, 'b': 2, 'c': 3})
+
+    def test_set_with_ttl_should_store_expiration_date(self):
+        my_dict = MongoDict(**self.config)
+        my_dict.set('temporary', 'value', ttl=60)
+        my_dict.set('permanent', 'value')
+        document = self.collection.find_one({'_id': 'temporary'})
+        expected = datetime.datetime.utcnow() + datetime.timedelta(seconds=60)
+        self.assertLess(abs((document['e'] - expected).total_seconds()), 5)
+        self.assertNotIn('e', self.collection.find_one({'_id': 'permanent'}))
+        index = self.collection.index_information()['e_1']
+        self.assertEqual(index['expireAfterSeconds'], 0)
+
+    def test_expired_keys_should_be_treated_as_missing(self):
+        my_dict = MongoDict(cache_size=10, **self.config)
+        past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        self.collection.insert({'_id': 'expired', 'v': Binary(encode(1)),
+                                'e': past})
+        my_dict.set('cached', 'value', ttl=0)
+        for key in ('expired', 'cached'):
+            self.assertNotIn(key, my_dict)
+            with self.assertRaises(KeyError):
+                temp = my_dict[key]
+        self.assertEqual(my_dict.get_many(['expired', 'cached']), {})
+        self.assertEqual(my_dict.contains_many(['expired', 'cached']), set())
+        self.assertEqual(list(my_dict.keys()), [])
+        self.assertEqual(list(my_dict.items()), [])
+
+    def test_del_and_incr_should_treat_expired_keys_as_missing(self):
+        my_dict = MongoDict(**self.config)
+        past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        for key in ('a', 'b', 'c'):
+            self.collection.insert({'_id': key, 'v': 10, 'c': 'bson',
+                                    'e': past})
+        with self.assertRaises(KeyError):
+            del my_dict['a']
+        with my_dict.write_concern(w=1, j=True):
+            with self.assertRaises(KeyError):
+                del my_dict['b']
+        self.assertEqual(my_dict.incr('c', 3), 3)
+        self.assertNotIn('e', self.collection.find_one({'_id': 'c'}))
+        self.assertEqual(my_dict['c'], 3)
+        with my_dict.write_concern(w=1, j=True):
+            self.assertEqual(my_dict.incr('b'), 1)
+        self.assertEqual(my_dict['b'], 1)
+
+    def test_incr_many_should_treat_expired_keys_as_missing(self):
+        my_dict = MongoDict(**self.config)
+        past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        self.collection.insert([{'_id': 'a', 'v': 10, 'c': 'bson',
+                                 'e': past},
+                                {'_id': 'b', 'v': Binary(encode('text')),
+                                 'e': past},
+                                {'_id': 'c', 'v': 5, 'c': 'bson'}])
+        results = my_dict.incr_many([('a', 1), ('b', 2), ('c', 3),
+                                     ('d', 4)])
+        self.assertEqual(len(results), 1)
+        self.assertEqual(my_dict.get_many(['a', 'b', 'c', 'd']),
+                         {'a': 1, 'b': 2, 'c': 8, 'd': 4})
+        self.assertNotIn('e', self.collection.find_one({'_id': 'a'}))
+        self.assertEqual(len(my_dict), 4)
+
+    def test_default_ttl_should_be_used_by_all_writes(self):
+        my_dict = MongoDict(ttl=60, **self.config)
+        my_dict['a'] = 1
+        my_dict.update({'b': 2})
+        my_dict.set('c', 3, ttl=None)
+        self.assertIn('e', self.collection.find_one({'_id': 'a'}))
+        self.assertIn('e', self.collection.find_one({'_id': 'b'}))
+        self.assertNotIn('e', self.collection.find_one({'_id': 'c'}))
+        self.assertEqual(my_dict.get_many(['a', 'b', 'c']),
+                         {'a': 1, 'b': 2, 'c': 3})
+
+    def test_compare_and_set_should_check_version(self):
+        my_dict = MongoDict(**self.config)
+        self.assertTrue(my_dict.compare_and_set('key', 'first', 0))
+        self.assertFalse(my_dict.compare_and_set('key', 'other', 0))
+        self.assertEqual(my_dict.get_with_version('key'), ('first', 1))
+        my_dict['key'] = 'second'
+        self.assertEqual(my_dict.get_with_version('key'), ('second', 2))
+        self.assertFalse(my_dict.compare_and_set('key', 'stale', 1))
+        self.assertTrue(my_dict.compare_and_set('key', 'third', 2))
+        self.assertEqual(my_dict.get_with_version('key'), ('third', 3))
+        self.assertEqual(len(my_dict), 1)
+
+    def test_update_with_should_retry_on_concurrent_writes(self):
+        my_dict = MongoDict(**self.config)
+        other_dict = MongoDict(**self.config)
+        my_dict['counter'] = 1
+        calls = []
+
+        def increment(value):
+            calls.append(value)
+            if len(calls) == 1: # someone else writes in the meantime
+                other_dict['counter'] = 10
+            return value + 1
+
+        self.assertEqual(my_dict.update_with('counter', increment), 11)
+        self.assertEqual(calls, [1, 10])
+        self.assertEqual(my_dict['counter'], 11)
+        self.assertEqual(my_dict.update_with('new', increment, default=0), 1)
+        with self.assertRaises(KeyError):
+            my_dict.update_with('missing', increment)
+
+        def conflicting(value):
+            other_dict['counter'] = 0
+            return value + 1
+
+        with self.assertRaises(VersionConflict):
+            my_dict.update_with('counter', conflicting, retries=2)
+        self.assertEqual(my_dict['counter'], 0)
+
+    def test_sharded_mongodict_should_spread_keys_over_shards(self):
+        shards = [{'collection': 'shard1'}, {'collection': 'shard2'},
+                  {'collection': 'shard3'}]
+        my_dict = ShardedMongoDict(shards, host=self.config['host'],
+                                   port=self.config['port'],
+                                   database=self.config['database'])
+        expected = dict(('key-{}'.format(i), i) for i in range(300))
+        my_dict.update(expected)
+        my_dict['single'] = 'value'
+        expected['single'] = 'value'
+        self.assertEqual(len(my_dict), 301)
+        self.assertEqual(dict(my_dict.items()), expected)
+        self.assertEqual(set(my_dict), set(expected))
+        self.assertEqual(my_dict.get_many(['key-1', 'key-2', 'missing']),
+                         {'key-1': 1, 'key-2': 2})
+        for shard_name in ('shard1', 'shard2', 'shard3'):
+            count = self.db[shard_name].count()
+            self.assertTrue(0 < count < 301)
+        for key in expected:
+            self.assertEqual(self.db[my_dict.shard_for(key)._collection.name]
+                             .find({'_id': key}).count(), 1)
+        del my_dict['single']
+        self.assertNotIn('single', my_dict)
+        my_dict.clear()
+        self.assertEqual(len(my_dict), 0)
+
+    def test_sharded_mongodict_add_shard_should_move_only_its_keys(self):
+        config = dict(self.config)
+        del config['collection']
+        my_dict = ShardedMongoDict([{'collection': 'shard1'},
+                                    {'collection': 'shard2'}], **config)
+        expected = dict(('key-{}'.format(i), i) for i in range(300))
+        my_dict.update(expected)
+        my_dict.set('temporary', 'value', ttl=3600)
+        before = dict((key, my_dict.shard_for(key)._collection.name)
+                      for key in my_dict)
+        new_shard = my_dict.add_shard({'collection': 'shard3'},
+                                      rebalance=False)
+        moved = [key for key in before
+                 if my_dict.shard_for(key) is new_shard]
+        self.assertTrue(moved)
+        self.assertEqual(my_dict.rebalance(), len(moved))
+        self.assertEqual(self.db['shard3'].count(), len(moved))
+        for key, collection_name in before.items():
+            if key not in moved:
+                self.assertEqual(my_dict.shard_for(key)._collection.name,
+                                 collection_name)
+        expected['temporary'] = 'value'
+        self.assertEqual(dict(my_dict.items()), expected)
+        self.assertEqual(len(my_dict), 301)
+        self.assertEqual(my_dict.rebalance(), 0)
+        document = my_dict.shard_for('temporary')._collection\
+                          .find_one({'_id': 'temporary'})
+        self.assertIn('e', document)
+
+    def test_read_from_should_override_read_preference(self):
+        my_dict = MongoDict(read_preference='secondary_preferred',
+                            **self.config)
+        my_dict['python'] = 'rules'
+        self.assertEqual(my_dict['python'], 'rules')
+        self.assertEqual(my_dict.get('python', read_from='primary'), 'rules')
+        self.assertEqual(my_dict.get('missing', 42, read_from='nearest'), 42)
+        self.assertEqual(my_dict.get_many(['python'], read_from='primary'),
+                         {'python': 'rules'})
+        with self.assertRaises(ValueError):
+            my_dict.get('python', read_from='anywhere')
+        with self.assertRaises(ValueError):
+            MongoDict(read_preference='anywhere', **self.config)
+
+    def test_max_staleness_should_read_from_primary_if_lagging(self):
+        my_dict = MongoDict(read_preference='secondary', max_staleness=30,
+                            **self.config)
+        my_dict._lag, my_dict._lag_time = 60, time.time()
+        self.assertEqual(my_dict._read_options(),
+                         {'read_preference': pymongo.ReadPreference.PRIMARY})
+        my_dict._lag = 10
+        self.assertEqual(my_dict._read_options(),
+                        {'read_preference': pymongo.ReadPreference.SECONDARY})
+        self.assertEqual(my_dict._read_options('primary'), {})
+
+    def test_write_concern_can_be_changed_per_call_and_per_block(self):
+        my_dict = MongoDict(write_concern={'w': 1, 'wtimeout': 5000},
+                            **self.config)
+        self.assertIsNotNone(my_dict.set('a', 1))
+        self.assertIsNone(my_dict.set('b', 2, write_concern={'w': 0}))
+        self.assertEqual(my_dict.set_many({'c': 3}, write_concern={'w': 0}),
+                         [None])
+        with my_dict.write_concern(w=0):
+            self.assertIsNone(my_dict.set('d', 4))
+            self.assertIsNotNone(my_dict.set('e', 5, write_concern={'w': 1}))
+            self.assertTrue(my_dict.compare_and_set('f', 6, 0))
+        self.assertIsNotNone(my_dict.set('g', 7))
+        with self.assertRaises(ValueError):
+            MongoDict(write_concern={'x': 1}, **self.config)
+        with self.assertRaises(ValueError):
+            with my_dict.write_concern(safe=False):
+                pass
+
+    def test_del_and_incr_should_use_write_concern_of_block(self):
+        my_dict = MongoDict(chunk_threshold=1000, chunk_size=300,
+                            **self.config)
+        chunks = self.db[self.config['collection'] + '.chunks']
+        my_dict['a'] = 1
+        my_dict['big'] = list(range(1000))
+        with my_dict.write_concern(w=1, j=True):
+            round_trips = my_dict.round_trips
+            del my_dict['a'] # it had no chunks
+            self.assertEqual(my_dict.round_trips, round_trips + 1)
+            with self.assertRaises(KeyError):
+                del my_dict['a']
+            del my_dict['big']
+            self.assertEqual(my_dict.incr('counter', 3), 3)
+            self.assertEqual(my_dict.incr('counter'), 4)
+        self.assertEqual(self.collection.find().count(), 1)
+        self.assertEqual(chunks.find().count(), 0)
+        self.assertEqual(len(my_dict), 1)
+        with my_dict.write_concern(w=0):
+            del my_dict['counter']
+            with self.assertRaises(KeyError):
+                del my_dict['counter']
+        self.assertNotIn('counter', my_dict)
+
+    def test_writes_without_chunks_should_not_remove_chunks(self):
+        my_dict = MongoDict(chunk_threshold=1000, chunk_size=300,
+                            **self.config)
+        chunks = self.db[self.config['collection'] + '.chunks']
+        with my_dict.write_concern(w=1, j=True):
+            for value in ('small', 'other'):
+                round_trips = my_dict.round_trips
+                my_dict['a'] = value
+                self.assertEqual(my_dict.round_trips, round_trips + 1)
+            my_dict['a'] = list(range(1000))
+            my_dict['a'] = 'small again'
+        self.assertEqual(my_dict['a'], 'small again')
+        self.assertEqual(chunks.find().count(), 0)
+
+        my_dict['b'] = list(range(1000))
+        with my_dict.write_concern(w=0): # the old chunks are left behind
+            my_dict['b'] = 'small'
+        deadline = time.time() + 5
+        while my_dict['b'] != 'small' and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(my_dict['b'], 'small')
+        self.assertNotEqual(chunks.find().count(), 0)
+        self.assertEqual(my_dict.remove_orphan_chunks(min_age=-60), 1)
+        self.assertEqual(chunks.find().count(), 0)
+
+    def test_stats_should_measure_mapping_operations(self):
+        my_dict = MongoDict(**self.config)
+        my_dict['a'] = 1
+        self.assertIsNone(my_dict.stats())
+        my_dict = MongoDict(collect_stats=True, **self.config)
+        my_dict['python'] = 'rules'
+        self.assertEqual(my_dict['python'], 'rules')
+        with self.assertRaises(KeyError):
+            temp = my_dict['missing']
+        self.assertIn('python', my_dict)
+        self.assertEqual(len(my_dict), 2)
+        self.assertEqual(set(my_dict), set(['a', 'python']))
+        del my_dict['python']
+        stats = my_dict.stats()
+        operations = stats['operations']
+        self.assertEqual(operations['__getitem__']['calls'], 2)
+        self.assertEqual(operations['__getitem__']['errors'], 1)
+        for operation in ('__setitem__', '__contains__', '__len__',
+                          '__iter__', '__delitem__'):
+            self.assertEqual(operations[operation]['calls'], 1)
+            self.assertEqual(operations[operation]['errors'], 0)
+        for operation in operations.values():
+            self.assertEqual(sum(operation['histogram']), operation['calls'])
+            self.assertEqual(len(operation['histogram']),
+                             len(stats['buckets']) + 1)
+        self.assertEqual(stats['encoded'], 1)
+        self.assertEqual(stats['decoded'], 1)
+        self.assertGreater(stats['bytes_sent'], len('python'))
+        self.assertGreater(stats['bytes_received'], 0)
+        my_dict.reset_stats()
+        self.assertEqual(my_dict.stats()['operations'], {})
+        self.assertEqual(my_dict.stats()['encoded'], 0)
+
+    def test_stats_should_measure_named_operations(self):
+        my_dict = MongoDict(collect_stats=True, **self.config)
+        my_dict.set('a', 1)
+        my_dict.set_many({'b': 2, 'c': 3})
+        my_dict.update({'d': 4})
+        self.assertEqual(my_dict.get('a'), 1)
+        self.assertIsNone(my_dict.get('missing'))
+        self.assertEqual(my_dict.get_many(['a', 'b']), {'a': 1, 'b': 2})
+        operations = my_dict.stats()['operations']
+        self.assertEqual(operations['get']['calls'], 2)
+        self.assertEqual(operations['get']['errors'], 1)
+        for operation in ('set', 'set_many', 'update', 'get_many'):
+            self.assertEqual(operations[operation]['calls'], 1)
+            self.assertEqual(operations[operation]['errors'], 0)
+        self.assertNotIn('__setitem__', operations)
+        self.assertNotIn('__getitem__', operations)
+
+    def test_failed_flush_should_keep_buffered_writes(self):
+        my_dict = MongoDict(buffer_size=10, chunk_threshold=10 ** 9,
+                            codec='raw', **self.config)
+        my_dict['a'] = b'python'
+        my_dict['huge'] = b'x' * (17 * 1024 * 1024) # too big for BSON
+        with self.assertRaises(Exception):
+            my_dict.flush()
+        self.assertEqual(sorted(my_dict._pending.keys()), ['a', 'huge'])
+        del my_dict._pending['huge']
+        my_dict.flush()
+        self.assertEqual(my_dict._pending, {})
+        self.assertEqual(self.collection.find().count(), 1)
+
+    def test_failed_write_should_not_be_cached(self):
+        my_dict = MongoDict(cache_size=10, chunk_threshold=10 ** 9,
+                            codec='raw', **self.config)
+        my_dict['a'] = b'python'
+        huge = b'x' * (17 * 1024 * 1024) # too big for BSON
+        with self.assertRaises(Exception):
+            my_dict['a'] = huge
+        with self.assertRaises(Exception):
+            my_dict.set_many({'a': huge, 'b': b'rules'})
+        self.assertNotIn('a', my_dict._cache)
+        self.assertNotIn('b', my_dict._cache)
+        self.assertEqual(my_dict['a'], b'python')
+        self.assertNotIn('b', my_dict)
+
+    def test_named_codecs_should_read_documents_of_default_codec(self):
+        default_dict = MongoDict(**self.config)
+        default_dict['a'] = {'python': [1, 2]}
+        default_dict['b'] = 'rules'
+        for codec in ('json', 'marshal', 'raw'):
+            my_dict = MongoDict(codec=codec, **self.config)
+            self.assertEqual(my_dict['a'], {'python': [1, 2]})
+            self.assertEqual(my_dict.get_many(['b']), {'b': 'rules'})
+        json_dict = MongoDict(codec='json', **self.config)
+        json_dict['c'] = [3]
+        self.assertEqual(default_dict['c'], [3])
+
     # TODO: test types of keys (str, unicode)?
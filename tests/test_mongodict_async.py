@@ -0,0 +1,83 @@
+# coding: utf-8
+
+import sys
+import unittest
+
+if sys.version_info < (3, 5):
+    raise unittest.SkipTest('AsyncMongoDict requires Python 3.5+')
+
+import asyncio
+
+import pymongo
+
+# async syntax lives in modules which are imported only on Python 3.5+
+from async_helpers_py35 import collect
+from mongodict import MongoDict, close_clients
+from mongodict_async import AsyncMongoDict
+
+
+class TestAsyncMongoDict(unittest.TestCase):
+    def setUp(self):
+        self.config = {'host': 'localhost', 'port': 27017,
+                       'database': 'mongodict', 'collection': 'async',}
+        self.connection = pymongo.Connection(host=self.config['host'],
+                port=self.config['port'], safe=True)
+        self.db = self.connection[self.config['database']]
+        self.loop = asyncio.new_event_loop()
+        self.my_dict = AsyncMongoDict(loop=self.loop, **self.config)
+
+    def tearDown(self):
+        self.my_dict.close()
+        self.loop.close()
+        self.connection.drop_database(self.db)
+        close_clients()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_basic_operations(self):
+        self.run_async(self.my_dict.set('python', 'rules'))
+        self.assertEqual(self.run_async(self.my_dict.get('python')), 'rules')
+        self.assertTrue(self.run_async(self.my_dict.contains('python')))
+        self.assertEqual(self.run_async(self.my_dict.len()), 1)
+        self.run_async(self.my_dict.delete('python'))
+        self.assertIsNone(self.run_async(self.my_dict.get('python')))
+        with self.assertRaises(KeyError):
+            self.run_async(self.my_dict.delete('python'))
+
+    def test_should_share_collection_with_MongoDict(self):
+        sync_dict = MongoDict(**self.config)
+        sync_dict['a'] = [1, 2]
+        self.assertEqual(self.run_async(self.my_dict.get('a')), [1, 2])
+        self.run_async(self.my_dict.set('b', {3: 4}))
+        self.assertEqual(sync_dict['b'], {3: 4})
+
+    def test_concurrent_lookups(self):
+        self.run_async(self.my_dict.set_many((str(i), i) for i in range(50)))
+        lookups = [self.my_dict.get(str(i)) for i in range(50)]
+        results = self.run_async(asyncio.gather(*lookups))
+        self.assertEqual(results, list(range(50)))
+
+    def test_async_iteration_over_keys_and_items(self):
+        self.run_async(self.my_dict.set_many((str(i), i) for i in range(25)))
+        keys = self.run_async(collect(self.my_dict.keys(batch_size=10)))
+        self.assertEqual(sorted(keys), sorted(str(i) for i in range(25)))
+        items = self.run_async(collect(self.my_dict.items(batch_size=10)))
+        self.assertEqual(dict(items), dict((str(i), i) for i in range(25)))
+        keys = self.run_async(collect(self.my_dict))
+        self.assertEqual(len(keys), 25)
+
+    def test_get_many_should_accept_read_from(self):
+        self.run_async(self.my_dict.set_many({'a': 1, 'b': 2}))
+        result = self.run_async(self.my_dict.get_many(['a', 'b', 'c'],
+                                                      read_from='primary'))
+        self.assertEqual(result, {'a': 1, 'b': 2})
+
+    def test_iterators_should_not_block_when_created(self):
+        self.run_async(self.my_dict.set('a', 1))
+        round_trips = self.my_dict.sync.round_trips
+        keys = self.my_dict.keys()
+        items = self.my_dict.items()
+        self.assertEqual(self.my_dict.sync.round_trips, round_trips)
+        self.assertEqual(self.run_async(collect(keys)), ['a'])
+        self.assertEqual(self.run_async(collect(items)), [('a', 1)])